@@ -1,8 +1,94 @@
-from flask import Flask, render_template, request
-from main import whole_pipeline
+import time
+_import_start = time.perf_counter()
+
+import gzip
+import logging
+import hashlib
+import os
+from importlib.metadata import version
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, abort
+from data import config
+from main import whole_pipeline, pipeline_cache, pipeline_cache_key
+from utils.jobs import JobQueue, QueueFull
+from utils.metrics import metrics, log_event, memory_usage
+
+# Seconds spent importing the app, the heavy pipeline dependencies are only imported on first use
+IMPORT_SECONDS = time.perf_counter() - _import_start
 
 app = Flask(__name__)
 
+# Run the pipeline on a background job queue instead of inside the POST handler
+ASYNC_JOBS = getattr(config, "ASYNC_JOBS", True)
+# Seconds after which a running job is considered lost: the optimizers give up after OPTIMIZER_TIMEOUT,
+# the rest of the pipeline gets one request timeout on top of that
+JOB_STALE_AFTER = getattr(config, "JOB_STALE_AFTER",
+                          getattr(config, "OPTIMIZER_TIMEOUT", 120.0) + int(os.environ.get("GUNICORN_TIMEOUT", 120)))
+# Job states and results live in a SQLite file, so every gunicorn worker can serve every job
+job_queue = JobQueue(getattr(config, "JOB_STORE_PATH", "cache/jobs.sqlite3"),
+                     max_workers=getattr(config, "JOB_WORKERS", 2),
+                     max_pending=getattr(config, "JOB_MAX_PENDING", 16),
+                     stale_after=JOB_STALE_AFTER)
+
+logging.basicConfig(level=getattr(config, "LOG_LEVEL", "INFO"))
+
+log_event("startup", pid=os.getpid(), import_seconds=round(IMPORT_SECONDS, 6), **memory_usage())
+
+# Whether a request may ask for a sampling profile of its pipeline run with profile=1
+PROFILING_ENABLED = getattr(config, "PROFILING_ENABLED", False)
+
+# Responses smaller than this are sent uncompressed
+GZIP_MIN_SIZE = getattr(config, "GZIP_MIN_SIZE", 1024)
+GZIP_MIMETYPES = ("text/html", "text/css", "application/json", "application/javascript", "text/javascript")
+
+_plotly_js = None
+
+def get_plotly_js():
+    """
+    Returns the plotly.js bundle of the installed plotly package, with its gzipped copy and ETag.
+    """
+    global _plotly_js
+    if _plotly_js is None:
+        from plotly.offline import get_plotlyjs
+        source = get_plotlyjs().encode()
+        _plotly_js = (source, gzip.compress(source, compresslevel=9), hashlib.sha1(source).hexdigest())
+    return _plotly_js
+
+PLOTLY_VERSION = version("plotly")
+
+@app.context_processor
+def plotly_version():
+    return {"plotly_version": PLOTLY_VERSION}
+
+@app.route('/plotly.min.js')
+def plotly_js():
+    source, compressed, etag = get_plotly_js()
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+    gzipped = "gzip" in request.accept_encodings
+    response = Response(compressed if gzipped else source, mimetype="application/javascript")
+    if gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.set_etag(etag)
+    # The URL carries the plotly version, so the bundle can be cached for good
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    return response
+
+@app.after_request
+def compress_response(response):
+    if ("gzip" not in request.accept_encodings or response.direct_passthrough
+            or response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.mimetype not in GZIP_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
 companies = {
     "MSFT": "Microsoft Corporation",
     "AMZN": "Amazon.com, Inc.",
@@ -65,11 +151,58 @@ def index():
         start_date = request.form['start-date']
         end_date = request.form['end-date']
         
-        graph_data = whole_pipeline(selected_companies, start_date, end_date)
-        
-        return render_template('result.html', graph_data=graph_data)
+        # Optional risk profile inputs, the defaults match the pipeline's defaults
+        age = request.form.get('age', 35, type=int)
+        financial_state = request.form.get('financial-state', 0.5, type=float)
+        risk_aversion = request.form.get('risk-aversion', 0.5, type=float)
+        pipeline_args = (selected_companies, start_date, end_date, age, financial_state, risk_aversion)
+        # A profiled request always runs the pipeline, its profile is published on /metrics
+        profile = PROFILING_ENABLED and request.args.get('profile') == '1'
+        pipeline_kwargs = {"use_cache": not profile, "profile": profile}
+
+        if not ASYNC_JOBS:
+            graph_data = whole_pipeline(*pipeline_args, **pipeline_kwargs)
+            return render_template('result.html', graph_data=graph_data)
+
+        # Serve cached results right away, queue everything else
+        key = pipeline_cache_key(*pipeline_args)
+        graph_data = pipeline_cache.get(key) if not profile else None
+        if graph_data is not None:
+            metrics.incr("pipeline.cache_hits")
+            return render_template('result.html', graph_data=graph_data)
+        try:
+            job = job_queue.submit(key + (":profile" if profile else ""), whole_pipeline, *pipeline_args, **pipeline_kwargs)
+        except QueueFull:
+            return "The service is busy, please try again in a minute.", 503, {"Retry-After": "30"}
+        return redirect(url_for('job', job_id=job.id), code=303)
 
     return render_template('index.html', companies=companies)
 
+@app.route('/metrics')
+def metrics_endpoint():
+    # Both are light to create, FinancialBERT itself is only loaded when texts are scored
+    from data.sentiment import get_sentiment_engine
+    from data.sentiment_cache import get_sentiment_cache
+    return jsonify({
+        "metrics": metrics.snapshot(),
+        "pipeline_cache": pipeline_cache.stats(),
+        "sentiment_cache": get_sentiment_cache().stats(),
+        "sentiment_engine": get_sentiment_engine().stats(),
+        "jobs": job_queue.stats(),
+        "process": {"pid": os.getpid(), "import_seconds": IMPORT_SECONDS, **memory_usage()},
+    })
+
+@app.route('/jobs/<job_id>')
+def job(job_id):
+    job = job_queue.get(job_id) or abort(404)
+    if job.status == "done":
+        return render_template('result.html', graph_data=job.result)
+    return render_template('job.html', job=job)
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    job = job_queue.get(job_id, with_result=False) or abort(404)
+    return jsonify(job.to_dict())
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""
+Offline benchmarks of the pipeline stages on synthetic data.
+
+    python -m benchmarks.run --tickers 10 100 500 --years 1 5
+    python -m benchmarks.run --compare benchmarks/results/<before>.json benchmarks/results/<after>.json
+
+Results are written as JSON, one record per stage and panel size with the timings and the peak
+memory allocated by the stage, so runs can be compared between commits. Every panel also
+records how far the HRP weights are from pypfopt's HRPOpt, as an error above HRP_TOLERANCE.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# Never reach out to the Hugging Face hub, the sentiment model is built locally
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import price_panel, news_articles, tiny_sentiment_model
+
+def measure(function, repeats):
+    """
+    Times repeated calls of function, then runs it once more under tracemalloc for its peak memory.
+    :return: dict of timings in seconds and peak_memory_bytes
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "repeats": repeats,
+        "seconds_min": min(times),
+        "seconds_median": float(np.median(times)),
+        "seconds_max": max(times),
+        "peak_memory_bytes": peak,
+    }
+
+def run_case(results, case, function, repeats, **params):
+    record = {"case": case, **params}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            record.update(measure(function, repeats))
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    results.append(record)
+    timing = f"{record['seconds_median'] * 1000:10.2f} ms" if "error" not in record else f"error - {record['error']}"
+    print(f"{case:<32} {json.dumps(params):<36} {timing}", flush=True)
+    return record
+
+def bench_panel(results, n_tickers, years, repeats, seed):
+    from data.stock_data import preprocess_data, select_low_correlation_stocks
+    from optimization_models.market_statistics import MarketStatistics
+    from optimization_models.PortfolioOptimizer import PortfolioOptimizer, MODELS
+    from optimization_models.frontier import EfficientFrontierEngine
+    from utils import plot_utils
+
+    params = {"tickers": n_tickers, "years": years}
+    raw = price_panel(n_tickers, years, seed=seed, missing=0.001, late_listings=0.05)
+    clean = preprocess_data(raw, ffill_limit=5, min_coverage=0.8)
+
+    run_case(results, "preprocess_data", lambda: preprocess_data(raw, ffill_limit=5, min_coverage=0.8), repeats, **params)
+    run_case(results, "select_low_correlation_stocks",
+             lambda: select_low_correlation_stocks(raw, n_stocks=min(10, n_tickers)), repeats, **params)
+
+    def market_statistics():
+        stats = MarketStatistics(clean)
+        stats.returns, stats.shrunk_cov, stats.mean_historical_return, stats.capm_return
+        return stats
+    run_case(results, "market_statistics", market_statistics, repeats, **params)
+
+    # The models share statistics computed once, as they do in the pipeline
+    stats = market_statistics()
+    optimizer = PortfolioOptimizer(clean, max_workers=1, market_stats=stats)
+    portfolios = []
+    for model in MODELS:
+        record = run_case(results, f"optimize.{model}", lambda: optimizer.optimize(model), repeats, **params)
+        if "error" not in record:
+            with contextlib.redirect_stdout(io.StringIO()):
+                portfolios.append(optimizer.optimize(model))
+
+    check_hrp(results, stats, **params)
+
+    engine = EfficientFrontierEngine.from_market_statistics(stats)
+    run_case(results, "efficient_frontier", lambda: engine.sweep(n_points=50), repeats, **params)
+
+    if portfolios:
+        frontier = engine.sweep(n_points=50)
+
+        def plot():
+            plot_utils._figure_cache.clear()
+            return plot_utils.plot_portfolios(portfolios, frontier)
+        run_case(results, "plot_portfolios", plot, repeats, **params)
+
+# Largest weight difference allowed between HierarchicalRiskParity and pypfopt's HRPOpt
+HRP_TOLERANCE = 1e-9
+
+def check_hrp(results, stats, **params):
+    """
+    Records the largest weight difference between HierarchicalRiskParity and pypfopt's HRPOpt,
+    an error when it exceeds HRP_TOLERANCE.
+    """
+    from pypfopt import HRPOpt
+    from optimization_models.hrp import HierarchicalRiskParity
+
+    expected = pd.Series(HRPOpt(stats.returns).optimize())
+    weights = pd.Series(HierarchicalRiskParity(stats.sample_cov, stats.returns).optimize())
+    max_difference = float((weights - expected.reindex(weights.index)).abs().max())
+    record = {"case": "hrp.matches_pypfopt", **params, "max_weight_difference": max_difference}
+    if not max_difference <= HRP_TOLERANCE:
+        record["error"] = f"weights differ from HRPOpt by {max_difference:.3g} > {HRP_TOLERANCE:g}"
+    results.append(record)
+    print(f"{record['case']:<32} {json.dumps(params):<36} {record.get('error', f'max difference {max_difference:.3g}')}")
+
+def bench_sentiment(results, n_tickers, n_articles, repeats, workdir):
+    from data.news_data import normalize_text, score_texts
+    from data.sentiment import SentimentEngine
+    from data.sentiment_cache import SentimentCache
+
+    params = {"tickers": n_tickers, "articles": n_tickers * n_articles}
+    try:
+        model_path = tiny_sentiment_model(os.path.join(workdir, "tiny-bert"))
+    except ImportError as e:
+        # transformers without torch, the rest of the suite still runs
+        reason = str(e).strip().splitlines()[0]
+        results.append({"case": "sentiment", **params, "skipped": reason})
+        print(f"{'sentiment':<32} skipped - {reason}")
+        return
+
+    articles = news_articles([f"T{i:04d}" for i in range(n_tickers)], n_articles)
+    texts = list(normalize_text(articles["title"] + " " + articles["description"]))
+    engine = SentimentEngine(model_path).load()
+    caches = iter(range(10 ** 6))
+
+    def cold():
+        # A new cache every run, so every text reaches the model
+        cache = SentimentCache(os.path.join(workdir, f"sentiment-{next(caches)}.sqlite3"))
+        return score_texts(texts, cache=cache, engine=engine)
+    run_case(results, "sentiment.cold_cache", cold, repeats, **params)
+
+    warm_cache = SentimentCache(os.path.join(workdir, "sentiment-warm.sqlite3"))
+    score_texts(texts, cache=warm_cache, engine=engine)
+    run_case(results, "sentiment.warm_cache", lambda: score_texts(texts, cache=warm_cache, engine=engine), repeats, **params)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(before_path, after_path):
+    """Prints the median time ratio (after / before) of every case found in both result files."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    def key(record):
+        return (record["case"], record.get("tickers"), record.get("years"), record.get("articles"))
+    before_records = {key(record): record for record in before["results"] if "seconds_median" in record}
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    for record in after["results"]:
+        previous = before_records.get(key(record))
+        if previous is None or "seconds_median" not in record:
+            continue
+        ratio = record["seconds_median"] / previous["seconds_median"]
+        memory_ratio = record["peak_memory_bytes"] / max(previous["peak_memory_bytes"], 1)
+        params = {name: value for name, value in zip(("tickers", "years", "articles"), key(record)[1:]) if value is not None}
+        print(f"{record['case']:<32} {json.dumps(params):<36} time x{ratio:6.2f}   memory x{memory_ratio:6.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tickers", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sentiment-tickers", type=int, default=50)
+    parser.add_argument("--articles", type=int, default=10, help="articles per ticker scored by the sentiment stage")
+    parser.add_argument("--output", help="JSON file to write, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = []
+    started_at = datetime.now(timezone.utc).isoformat()
+    for years in args.years:
+        for n_tickers in args.tickers:
+            bench_panel(results, n_tickers, years, args.repeats, args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        bench_sentiment(results, args.sentiment_tickers, args.articles, args.repeats, workdir)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "started_at": started_at,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    output = args.output or os.path.join("benchmarks", "results", f"{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
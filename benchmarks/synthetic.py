@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS = 252
+
+def price_panel(n_tickers, years, seed=0, missing=0.0, late_listings=0.0, n_factors=3):
+    """
+    Synthetic daily prices driven by a few common factors, so the tickers are realistically correlated.
+    :param n_tickers: number of tickers
+    :param years: number of years of business days
+    :param missing: fraction of prices randomly removed, e.g. exchange holidays or bad ticks
+    :param late_listings: fraction of tickers listed partway through the history
+    :return: DataFrame of prices indexed by business day, one column per ticker
+    """
+    rng = np.random.default_rng(seed)
+    n_days = int(years * TRADING_DAYS)
+    factors = rng.normal(0.0003, 0.01, (n_days, n_factors))
+    loadings = rng.normal(0.6, 0.3, (n_factors, n_tickers))
+    idiosyncratic = rng.normal(0.0, 0.015, (n_days, n_tickers))
+    returns = factors @ loadings / n_factors + idiosyncratic
+    prices = 100 * np.cumprod(1 + returns, axis=0)
+
+    if missing > 0:
+        prices[rng.random(prices.shape) < missing] = np.nan
+    if late_listings > 0:
+        late = rng.random(n_tickers) < late_listings
+        starts = rng.integers(n_days // 4, 3 * n_days // 4, n_tickers)
+        prices[np.arange(n_days)[:, None] < np.where(late, starts, 0)] = np.nan
+
+    index = pd.bdate_range("2000-01-03", periods=n_days, name="Date")
+    columns = [f"T{i:04d}" for i in range(n_tickers)]
+    return pd.DataFrame(prices, index=index, columns=columns)
+
+_WORDS = ("shares", "stock", "earnings", "revenue", "guidance", "record", "growth", "profit", "loss", "decline",
+          "rally", "surge", "falls", "beats", "misses", "expectations", "quarter", "analysts", "upgrade", "downgrade",
+          "investors", "market", "outlook", "strong", "weak", "dividend", "buyback", "lawsuit", "merger", "deal")
+
+def news_articles(tickers, n_articles=10, seed=0):
+    """
+    Stub NewsAPI articles with random headlines, in the frame fetch_news_data builds.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for ticker in tickers:
+        for _ in range(n_articles):
+            title = " ".join(rng.choice(_WORDS, 8))
+            description = " ".join(rng.choice(_WORDS, 24))
+            rows.append({"ticker": ticker, "title": f"{ticker} {title}", "description": description})
+    return pd.DataFrame(rows)
+
+def tiny_sentiment_model(directory):
+    """
+    Saves a randomly initialised two-layer BERT classifier with a small vocabulary, loadable
+    by SentimentEngine without any download. Its scores are meaningless, its cost per token is what matters.
+    :return: path of the saved model
+    """
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+
+    os.makedirs(directory, exist_ok=True)
+    vocab_path = os.path.join(directory, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *_WORDS]) + "\n")
+    BertTokenizer(vocab_path).save_pretrained(directory)
+
+    config = BertConfig(vocab_size=5 + len(_WORDS), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, max_position_embeddings=256, num_labels=3,
+                        id2label={0: "positive", 1: "negative", 2: "neutral"},
+                        label2id={"positive": 0, "negative": 1, "neutral": 2})
+    BertForSequenceClassification(config).save_pretrained(directory)
+    return directory
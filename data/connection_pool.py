@@ -0,0 +1,126 @@
+import threading
+import time
+from contextlib import contextmanager
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    Bounded pool of DB-API connections.
+    Connections are health-checked on checkout, committed when the scope exits normally
+    and rolled back when it raises.
+    :param connect: callable returning a new connection
+    :param max_size: maximum number of open connections
+    :param timeout: seconds to wait for a free connection before raising PoolTimeout
+    :param health_check_query: query run on idle connections before handing them out
+    """
+    def __init__(self, connect, max_size=5, timeout=30.0, health_check_query="SELECT 1"):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_query = health_check_query
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._metrics = {
+            "checkouts": 0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "checkout_seconds_total": 0.0,
+            "checkout_seconds_max": 0.0,
+        }
+
+    def _is_healthy(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute(self.health_check_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection):
+        with self._lock:
+            self._metrics["connections_discarded"] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        wait_start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        try:
+            connection = None
+            while connection is None:
+                with self._lock:
+                    idle = self._idle.pop() if self._idle else None
+                if idle is None:
+                    connection = self._connect()
+                    with self._lock:
+                        self._metrics["connections_created"] += 1
+                elif self._is_healthy(idle):
+                    connection = idle
+                else:
+                    self._discard(idle)
+        except BaseException:
+            self._slots.release()
+            raise
+        waited = time.perf_counter() - wait_start
+        with self._lock:
+            self._metrics["checkouts"] += 1
+            self._metrics["wait_seconds_total"] += waited
+            self._metrics["wait_seconds_max"] = max(self._metrics["wait_seconds_max"], waited)
+        return connection
+
+    def _release(self, connection, checkout_start, broken=False):
+        held = time.perf_counter() - checkout_start
+        with self._lock:
+            self._metrics["checkout_seconds_total"] += held
+            self._metrics["checkout_seconds_max"] = max(self._metrics["checkout_seconds_max"], held)
+        if broken:
+            self._discard(connection)
+        else:
+            with self._lock:
+                self._idle.append(connection)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks a connection out of the pool for the duration of a with-block.
+        """
+        connection = self._acquire()
+        checkout_start = time.perf_counter()
+        broken = False
+        try:
+            yield connection
+            connection.commit()
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self._release(connection, checkout_start, broken)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["idle_connections"] = len(self._idle)
+        checkouts = metrics["checkouts"]
+        metrics["wait_seconds_mean"] = metrics["wait_seconds_total"] / checkouts if checkouts else 0.0
+        metrics["checkout_seconds_mean"] = metrics["checkout_seconds_total"] / checkouts if checkouts else 0.0
+        return metrics
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
@@ -1,150 +1,435 @@
 from . import config
-import pyodbc
-import pickle
-import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
+from .connection_pool import ConnectionPool
+from utils.metrics import metrics
 
 # Connection and configuration details
 DATABASE_CONFIG = config.DATABASE_CONFIG
+# "mssql" for SQL Server through ODBC, "sqlite" for a local database file
+DATABASE_BACKEND = getattr(config, "DATABASE_BACKEND", "mssql")
+SQLITE_PATH = getattr(config, "SQLITE_PATH", "portfolio.sqlite3")
+# Number of rows sent to the server per executemany call
+BATCH_SIZE = 10_000
+# Maximum number of pooled connections per process
+POOL_SIZE = getattr(config, "DATABASE_POOL_SIZE", 5)
 
 def connect_to_database():
+    if DATABASE_BACKEND == "sqlite":
+        # Pooled connections are handed to whichever thread checks them out
+        return sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+    import pyodbc
     connection_string = ';'.join([f'{k}={v}' for k, v in DATABASE_CONFIG.items()])
     connection = pyodbc.connect(connection_string)
     return connection
 
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the process-wide connection pool, created on first use.
+    The missing tables are created before the pool hands out its first connection.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(connect_to_database, max_size=POOL_SIZE)
+                with pool.connection() as connection:
+                    create_schema(connection)
+                _pool = pool
+    return _pool
+
+# Typed schema: one row per (ticker, date) price and per (portfolio, ticker) weight
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS Tickers (
+        ID INTEGER PRIMARY KEY,
+        Symbol TEXT NOT NULL UNIQUE,
+        Name TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS StockPrices (
+        TickerID INTEGER NOT NULL REFERENCES Tickers (ID),
+        Date TEXT NOT NULL,
+        AdjClose REAL NOT NULL,
+        Volume REAL,
+        PRIMARY KEY (TickerID, Date)
+    )""",
+    """CREATE TABLE IF NOT EXISTS Articles (
+        TickerID INTEGER REFERENCES Tickers (ID),
+        Title TEXT NOT NULL,
+        Description TEXT,
+        Sentiment REAL,
+        UNIQUE (TickerID, Title)
+    )""",
+    """CREATE TABLE IF NOT EXISTS OptimizedPortfolios (
+        ID INTEGER PRIMARY KEY,
+        Name TEXT NOT NULL,
+        ExpectedReturns REAL,
+        Volatility REAL,
+        SharpeRatio REAL
+    )""",
+    """CREATE TABLE IF NOT EXISTS PortfolioWeights (
+        PortfolioID INTEGER NOT NULL REFERENCES OptimizedPortfolios (ID),
+        TickerID INTEGER NOT NULL REFERENCES Tickers (ID),
+        Weight REAL NOT NULL,
+        PRIMARY KEY (PortfolioID, TickerID)
+    )""",
+]
+
+MSSQL_SCHEMA = [
+    """IF OBJECT_ID('Tickers') IS NULL CREATE TABLE Tickers (
+        ID INT IDENTITY PRIMARY KEY,
+        Symbol NVARCHAR(16) NOT NULL UNIQUE,
+        Name NVARCHAR(256) NULL
+    )""",
+    """IF OBJECT_ID('StockPrices') IS NULL CREATE TABLE StockPrices (
+        TickerID INT NOT NULL REFERENCES Tickers (ID),
+        Date DATE NOT NULL,
+        AdjClose FLOAT NOT NULL,
+        Volume BIGINT NULL,
+        CONSTRAINT PK_StockPrices PRIMARY KEY CLUSTERED (TickerID, Date)
+    )""",
+    """IF OBJECT_ID('Articles') IS NULL CREATE TABLE Articles (
+        TickerID INT NULL REFERENCES Tickers (ID),
+        Title NVARCHAR(450) NOT NULL,
+        Description NVARCHAR(MAX) NULL,
+        Sentiment FLOAT NULL,
+        CONSTRAINT UQ_Articles UNIQUE (TickerID, Title)
+    )""",
+    """IF OBJECT_ID('OptimizedPortfolios') IS NULL CREATE TABLE OptimizedPortfolios (
+        ID INT IDENTITY PRIMARY KEY,
+        Name NVARCHAR(64) NOT NULL,
+        ExpectedReturns FLOAT NULL,
+        Volatility FLOAT NULL,
+        SharpeRatio FLOAT NULL
+    )""",
+    """IF OBJECT_ID('PortfolioWeights') IS NULL CREATE TABLE PortfolioWeights (
+        PortfolioID INT NOT NULL REFERENCES OptimizedPortfolios (ID),
+        TickerID INT NOT NULL REFERENCES Tickers (ID),
+        Weight FLOAT NOT NULL,
+        CONSTRAINT PK_PortfolioWeights PRIMARY KEY (PortfolioID, TickerID)
+    )""",
+]
+
+# Columns of the untyped layout, pickled yfinance objects and JSON weights
+LEGACY_COLUMNS = [("Tickers", "TickerObject"), ("OptimizedPortfolios", "CleanWeights")]
+
+def table_columns(cursor, table):
+    """
+    :return: names of the table's columns, empty if the table does not exist
+    """
+    if DATABASE_BACKEND == "sqlite":
+        cursor.execute(f"PRAGMA table_info({table})")
+        return [row[1] for row in cursor.fetchall()]
+    cursor.execute("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?", (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+def create_tables(cursor):
+    for statement in SQLITE_SCHEMA if DATABASE_BACKEND == "sqlite" else MSSQL_SCHEMA:
+        cursor.execute(statement)
+
+def create_schema(connection):
+    """
+    Creates the tables that do not exist yet, get_pool runs it once per process.
+    Databases still in the untyped layout are not migrated here, they have to be migrated once with
+    python -m data.migrate_legacy_schema
+    """
+    cursor = connection.cursor()
+    legacy = [f"{table}.{column}" for table, column in LEGACY_COLUMNS if column in table_columns(cursor, table)]
+    if legacy:
+        raise RuntimeError(f"The database still has the legacy columns {', '.join(legacy)}, "
+                           "migrate it with python -m data.migrate_legacy_schema")
+    create_tables(cursor)
+    cursor.close()
+
+def bulk_cursor(connection):
+    cursor = connection.cursor()
+    # Send parameter arrays in one round trip instead of one per row (pyodbc only)
+    if hasattr(cursor, "fast_executemany"):
+        cursor.fast_executemany = True
+    return cursor
+
+def execute_batched(cursor, query, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(query, rows[start:start + BATCH_SIZE])
+
+def upsert_rows(cursor, table, key_columns, value_columns, rows):
+    """
+    Inserts rows, updating the value columns of rows whose key columns already exist.
+    SQL Server stages the rows in a temporary table and merges them in one statement,
+    SQLite uses INSERT ... ON CONFLICT.
+    """
+    # Keep the last row per key, MERGE rejects sources that match a target row twice
+    n_keys = len(key_columns)
+    rows = list({tuple(row[:n_keys]): row for row in rows}.values())
+    if not rows:
+        return
+    columns = key_columns + value_columns
+    column_list = ", ".join(columns)
+    placeholders = ", ".join("?" * len(columns))
+    if DATABASE_BACKEND == "sqlite":
+        updates = ", ".join(f"{column} = excluded.{column}" for column in value_columns)
+        query = f"INSERT INTO {table} ({column_list}) VALUES ({placeholders}) ON CONFLICT ({', '.join(key_columns)}) DO "
+        query += f"UPDATE SET {updates}" if value_columns else "NOTHING"
+        execute_batched(cursor, query, rows)
+    else:
+        cursor.execute(f"SELECT TOP 0 {column_list} INTO #Staging FROM {table}")
+        execute_batched(cursor, f"INSERT INTO #Staging ({column_list}) VALUES ({placeholders})", rows)
+        match = " AND ".join(f"target.{column} = source.{column}" for column in key_columns)
+        query = f"MERGE {table} AS target USING #Staging AS source ON {match}"
+        if value_columns:
+            query += " WHEN MATCHED THEN UPDATE SET " + ", ".join(f"target.{column} = source.{column}" for column in value_columns)
+        query += f" WHEN NOT MATCHED THEN INSERT ({column_list}) VALUES ({', '.join('source.' + column for column in columns)});"
+        cursor.execute(query)
+        cursor.execute("DROP TABLE #Staging")
+
+def get_ticker_ids(cursor, symbols):
+    """
+    Looks up the IDs of many ticker symbols with a single query.
+    :return: dictionary of symbol -> ticker ID for the symbols found
+    """
+    symbols = list(dict.fromkeys(symbols))
+    ticker_ids = {}
+    # Stay below the bound parameter limits of both backends
+    for start in range(0, len(symbols), 500):
+        chunk = symbols[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"SELECT Symbol, ID FROM Tickers WHERE Symbol IN ({placeholders})", chunk)
+        ticker_ids.update((symbol, ticker_id) for symbol, ticker_id in cursor.fetchall())
+    return ticker_ids
+
+def ensure_ticker_ids(cursor, symbols):
+    """
+    Returns the IDs of ticker symbols, registering the symbols that are not stored yet.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    upsert_rows(cursor, "Tickers", ["Symbol"], [], [(symbol,) for symbol in symbols])
+    return get_ticker_ids(cursor, symbols)
+
 # region Tickers
 def store_tickers(tickers):
-    connection = connect_to_database()
-    # Loop through tickers and insert data into SQL Server
-    for ticker in tickers:
-        # Serialize the ticker object
-        pickled_ticker = pickle.dumps(ticker)
-        # Insert the serialized ticker into the database
-        connection.execute("INSERT INTO Tickers (TickerObject) VALUES (?)", (pickled_ticker))
-    # Commit the changes and close the connection
-    connection.commit()
-    connection.close()
+    """
+    Registers ticker symbols.
+    :param tickers: ticker symbols or yfinance Ticker objects
+    :return: number of tickers stored
+    """
+    symbols = [getattr(ticker, "ticker", ticker) for ticker in tickers]
+    with metrics.timer("store_tickers", rows=len(symbols)):
+        with get_pool().connection() as connection:
+            ensure_ticker_ids(bulk_cursor(connection), symbols)
+    return len(symbols)
 
 def load_tickers():
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    cursor.execute("SELECT TickerObject FROM Tickers")
-    rows = cursor.fetchall()
-    # Deserialize each ticker object and append to a list
-    tickers = []
-    for row in rows:
-        pickled_ticker = row[0]
-        ticker = pickle.loads(pickled_ticker)
-        tickers.append(ticker)
-    # Close the cursor and connection
-    cursor.close()
-    return tickers
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT Symbol FROM Tickers ORDER BY Symbol")
+        rows = cursor.fetchall()
+        cursor.close()
+    return [row[0] for row in rows]
 # endregion
 
 # region Stock Prices
 def store_stock_prices(stock_prices):
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    for stock_price in stock_prices.itertuples(index=False):
-        ticker_id = get_ticker_id(stock_price.ticker)  # Implement a function to retrieve the TickerID for the given ticker symbol
-        if ticker_id is not None:
-            date = stock_price.date
-            adj_close = stock_price.adj_close
-            volume = stock_price.volume
-            cursor.execute("INSERT INTO StockPrices (TickerID, Date, AdjClose, Volume) VALUES (?, ?, ?, ?)",
-                           ticker_id, date, adj_close, volume)
-    connection.commit()
-    connection.close()
-
-def load_stock_prices():
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    query = "SELECT t.Name, sp.Date, sp.AdjClose, sp.Volume FROM StockPrices sp JOIN Tickers t ON sp.TickerID = t.ID"
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    connection.close()
+    """
+    Stores long-format prices (ticker, date, adj_close, volume), replacing rows already stored.
+    :return: number of rows stored
+    """
+    stock_prices = stock_prices.dropna(subset=["adj_close"])
+    with metrics.timer("store_stock_prices", rows=len(stock_prices)):
+        with get_pool().connection() as connection:
+            cursor = bulk_cursor(connection)
+            ticker_ids = ensure_ticker_ids(cursor, stock_prices["ticker"].unique())
+
+            # Resolve the ticker IDs for the whole frame at once
+            volumes = [None if volume != volume else int(volume) for volume in stock_prices["volume"].astype(float).tolist()]
+            rows = list(zip(stock_prices["ticker"].map(ticker_ids).astype(int).tolist(),
+                            pd.to_datetime(stock_prices["date"]).dt.strftime("%Y-%m-%d").tolist(),
+                            stock_prices["adj_close"].astype(float).tolist(),
+                            volumes))
+            upsert_rows(cursor, "StockPrices", ["TickerID", "Date"], ["AdjClose", "Volume"], rows)
+    return len(rows)
+
+def store_price_matrix(stock_data):
+    """
+    Stores a wide price frame (dates x tickers) in the long StockPrices table.
+    """
+    stock_prices = stock_data.rename_axis(index="date", columns="ticker").stack().rename("adj_close").reset_index()
+    stock_prices["volume"] = float("nan")
+    return store_stock_prices(stock_prices)
+
+def _price_filters(tickers, start_date, end_date):
+    # Build a WHERE clause so the database only returns the requested tickers and dates
+    conditions, params = [], []
+    if tickers is not None:
+        tickers = list(tickers)
+        # IN () is a syntax error, no ticker matches an empty list
+        conditions.append(f"t.Symbol IN ({', '.join('?' * len(tickers))})" if tickers else "1 = 0")
+        params.extend(tickers)
+    if start_date is not None:
+        conditions.append("sp.Date >= ?")
+        params.append(pd.Timestamp(start_date).strftime("%Y-%m-%d"))
+    if end_date is not None:
+        conditions.append("sp.Date < ?")
+        params.append(pd.Timestamp(end_date).strftime("%Y-%m-%d"))
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+def load_stock_prices(tickers=None, start_date=None, end_date=None):
+    """
+    Loads long-format prices, filtered by ticker and by the [start_date, end_date) range in the database.
+    """
+    where, params = _price_filters(tickers, start_date, end_date)
+    query = f"SELECT t.Symbol, sp.Date, sp.AdjClose, sp.Volume FROM StockPrices sp JOIN Tickers t ON sp.TickerID = t.ID{where}"
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
 
-    stock_prices = pd.DataFrame(rows, columns=["ticker", "date", "adj_close", "volume"])
+    stock_prices = pd.DataFrame.from_records(rows, columns=["ticker", "date", "adj_close", "volume"])
+    stock_prices["date"] = pd.to_datetime(stock_prices["date"])
     return stock_prices
+
+def load_price_matrix(tickers=None, start_date=None, end_date=None, chunk_size=BATCH_SIZE):
+    """
+    Loads prices into a wide float64 DataFrame (dates x tickers).
+    Rows are streamed from the cursor in chunks, filtering happens in the database.
+    """
+    where, params = _price_filters(tickers, start_date, end_date)
+    query = f"SELECT t.Symbol, sp.Date, sp.AdjClose FROM StockPrices sp JOIN Tickers t ON sp.TickerID = t.ID{where}"
+    symbols, dates, prices = [], [], []
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for symbol, date, price in rows:
+                symbols.append(symbol)
+                dates.append(date)
+                prices.append(price)
+
+    stock_data = pd.DataFrame({"Date": pd.to_datetime(dates), "ticker": symbols,
+                               "price": np.asarray(prices, dtype=np.float64)})
+    stock_data = stock_data.pivot(index="Date", columns="ticker", values="price").sort_index()
+    stock_data.columns.name = None
+    if tickers is not None:
+        stock_data = stock_data.reindex(columns=list(tickers))
+    return stock_data
 # endregion
 
 # region Articles
 def store_articles(articles):
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    for row in articles.itertuples(index=False):
-        result = cursor.execute("SELECT ID FROM Tickers WHERE Symbol = ?", row.ticker).fetchone()
-        if result is not None:
-            ticker_id = result[0]
-        else:
-            ticker_id = None # Or whatever default value we want to use
-        cursor.execute("INSERT INTO Articles (TickerID, Title, Description, Sentiment) VALUES (?, ?, ?, ?)",
-                       ticker_id, row.title, row.description, row.sentiment)
-    connection.commit()
-    connection.close()
+    """
+    Stores scored articles, replacing the sentiment of articles already stored.
+    Articles without a ticker are skipped, a NULL TickerID never matches the stored row and would be inserted again.
+    :return: number of rows stored
+    """
+    articles = articles.dropna(subset=["ticker"])
+    with metrics.timer("store_articles") as stage:
+        with get_pool().connection() as connection:
+            cursor = bulk_cursor(connection)
+            ticker_ids = ensure_ticker_ids(cursor, articles["ticker"].unique())
+
+            rows = [(ticker_ids[ticker], title, description, float(sentiment))
+                    for ticker, title, description, sentiment
+                    in zip(articles["ticker"], articles["title"], articles["description"], articles["sentiment"])
+                    if ticker in ticker_ids]
+            upsert_rows(cursor, "Articles", ["TickerID", "Title"], ["Description", "Sentiment"], rows)
+        stage["rows"] = len(rows)
+    return len(rows)
 
 def load_articles():
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    articles_data = cursor.execute("SELECT t.Symbol, a.Title, a.Description, a.Sentiment FROM Articles a JOIN Tickers t ON a.TickerID = t.ID").fetchall()
-    connection.close()
-    
-    articles = pd.DataFrame(articles_data, columns=["ticker", "title", "description", "sentiment"])
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        articles_data = cursor.execute("SELECT t.Symbol, a.Title, a.Description, a.Sentiment FROM Articles a JOIN Tickers t ON a.TickerID = t.ID").fetchall()
+
+    articles = pd.DataFrame.from_records(articles_data, columns=["ticker", "title", "description", "sentiment"])
     return articles
 # endregion
 
 # region Optimized portfolios
 def store_optimized_portfolio(portfolio):
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    
+    """
+    Stores a portfolio's performance in OptimizedPortfolios and one PortfolioWeights row per asset.
+    """
     name = portfolio.name
-    serialized_clean_weights = json.dumps(portfolio.clean_weights)
     mu, sigma, sharpe = portfolio.expected_returns, portfolio.volatility, portfolio.sharpe_ratio
+    params = (name, float(mu), float(sigma), float(sharpe))
 
-    query = """
-        INSERT INTO OptimizedPortfolios (Name, CleanWeights, ExpectedReturns, Volatility, SharpeRatio)
-        VALUES (?, ?, ?, ?, ?)
-    """
-    params = (name, serialized_clean_weights, mu, sigma, sharpe)
-    cursor.execute(query, params)
-    connection.commit()
-    connection.close()
+    with get_pool().connection() as connection:
+        cursor = bulk_cursor(connection)
+        if DATABASE_BACKEND == "sqlite":
+            cursor.execute("""
+                INSERT INTO OptimizedPortfolios (Name, ExpectedReturns, Volatility, SharpeRatio)
+                VALUES (?, ?, ?, ?)
+            """, params)
+            portfolio_id = cursor.lastrowid
+        else:
+            cursor.execute("""
+                INSERT INTO OptimizedPortfolios (Name, ExpectedReturns, Volatility, SharpeRatio)
+                OUTPUT INSERTED.ID
+                VALUES (?, ?, ?, ?)
+            """, params)
+            portfolio_id = cursor.fetchone()[0]
 
-def load_optimized_portfolio(name):
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    query = "SELECT Name, CleanWeights, ExpectedReturns, Volatility, SharpeRatio FROM OptimizedPortfolios"
-    cursor.execute(query)
-    result = cursor.fetchone()
+        weights = portfolio.clean_weights
+        ticker_ids = ensure_ticker_ids(cursor, weights.keys())
+        rows = [(portfolio_id, ticker_ids[ticker], float(weight)) for ticker, weight in weights.items()]
+        execute_batched(cursor, "INSERT INTO PortfolioWeights (PortfolioID, TickerID, Weight) VALUES (?, ?, ?)", rows)
 
-    if result is None:
-        return None
+def _load_weights(cursor, portfolio_ids):
+    # Fetch the weights of all requested portfolios in one query
+    weights = {portfolio_id: OrderedDict() for portfolio_id in portfolio_ids}
+    portfolio_ids = list(portfolio_ids)
+    for start in range(0, len(portfolio_ids), 500):
+        chunk = portfolio_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"""
+            SELECT pw.PortfolioID, t.Symbol, pw.Weight
+            FROM PortfolioWeights pw JOIN Tickers t ON pw.TickerID = t.ID
+            WHERE pw.PortfolioID IN ({placeholders})
+            ORDER BY pw.PortfolioID, t.Symbol
+        """, chunk)
+        for portfolio_id, symbol, weight in cursor.fetchall():
+            weights[portfolio_id][symbol] = weight
+    return weights
 
-    name = result[0]
-    weights = json.loads(result[1])
-    expected_returns = result[2]
-    volatility = result[3]
-    sharpe_ratio = result[4]
+def load_optimized_portfolio(name):
+    """
+    Loads the most recently stored portfolio with the given name (case-insensitive).
+    """
+    query = """
+        SELECT ID, Name, ExpectedReturns, Volatility, SharpeRatio FROM OptimizedPortfolios
+        WHERE LOWER(Name) = LOWER(?)
+        ORDER BY ID DESC
+    """
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, (name,))
+        result = cursor.fetchone()
+        if result is None:
+            return None
+        weights = _load_weights(cursor, [result[0]])[result[0]]
 
+    _, name, expected_returns, volatility, sharpe_ratio = result
     return name, weights, expected_returns, volatility, sharpe_ratio
 
 def load_all_optimized_portfolios():
-    connection = connect_to_database()
-    cursor = connection.cursor()
-    query = "SELECT Name, CleanWeights, ExpectedReturns, Volatility, SharpeRatio FROM OptimizedPortfolios"
-    cursor.execute(query)
-    results = cursor.fetchall()
+    query = "SELECT ID, Name, ExpectedReturns, Volatility, SharpeRatio FROM OptimizedPortfolios ORDER BY ID"
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query)
+        results = cursor.fetchall()
+        weights = _load_weights(cursor, [row[0] for row in results])
 
     portfolios = []
-    for row in results:
-        name = row[0]
-        clean_serialized_weights = row[1]
-        clean_weights = json.loads(clean_serialized_weights)
-        expected_returns = row[2]
-        volatility = row[3]
-        sharpe_ratio = row[4]
-        portfolio = name, clean_weights, expected_returns, volatility, sharpe_ratio
+    for portfolio_id, name, expected_returns, volatility, sharpe_ratio in results:
+        portfolio = name, weights[portfolio_id], expected_returns, volatility, sharpe_ratio
         portfolios.append(portfolio)
 
     return portfolios
@@ -0,0 +1,141 @@
+"""
+One-off migration of a database created with the untyped layout to the typed schema.
+
+    python -m data.migrate_legacy_schema --dry-run
+    python -m data.migrate_legacy_schema
+
+Tickers rows held pickled yfinance objects, one row per store_tickers call, and OptimizedPortfolios
+held the weights as a JSON string. The migration recovers the symbols, merges the rows of the same
+symbol, and moves the weights into PortfolioWeights, all in one transaction. When a row's symbol
+cannot be recovered nothing is changed: set the row's Symbol by hand and run the migration again.
+"""
+import argparse
+import json
+import pickle
+from . import database
+
+class MigrationError(Exception):
+    pass
+
+def legacy_symbol(pickled_ticker, name):
+    """
+    Recovers the symbol of a legacy Tickers row from its pickled yfinance Ticker or symbol string,
+    falling back to the name the old price queries joined on.
+    :return: the symbol, None if it cannot be recovered
+    """
+    try:
+        ticker = pickle.loads(pickled_ticker) if pickled_ticker is not None else None
+    except Exception:
+        ticker = None
+    symbol = ticker if isinstance(ticker, str) else getattr(ticker, "ticker", None)
+    if not symbol and name and len(name) <= 16:
+        symbol = name
+    return symbol.strip() if isinstance(symbol, str) and symbol.strip() else None
+
+def _migrate_tickers(cursor):
+    columns = database.table_columns(cursor, "Tickers")
+    if "TickerObject" not in columns:
+        return 0
+    symbol_column = "Symbol" if "Symbol" in columns else "NULL"
+    name_column = "Name" if "Name" in columns else "NULL"
+    cursor.execute(f"SELECT ID, TickerObject, {name_column}, {symbol_column} FROM Tickers ORDER BY ID")
+    symbols, unmapped = {}, []
+    for ticker_id, pickled_ticker, name, symbol in cursor.fetchall():
+        symbol = symbol or legacy_symbol(pickled_ticker, name)
+        if symbol:
+            symbols[ticker_id] = symbol
+        else:
+            unmapped.append(ticker_id)
+    # Check every row before changing anything, rows that cannot be mapped are never dropped
+    if unmapped:
+        raise MigrationError(f"No symbol could be recovered for the Tickers rows with ID {', '.join(map(str, unmapped))}, "
+                             "set their Symbol and run the migration again")
+
+    sqlite = database.DATABASE_BACKEND == "sqlite"
+    for column, definition in (("Symbol", "TEXT" if sqlite else "NVARCHAR(16) NULL"), ("Name", "TEXT" if sqlite else "NVARCHAR(256) NULL")):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE Tickers ADD {'COLUMN ' if sqlite else ''}{column} {definition}")
+    database.execute_batched(cursor, "UPDATE Tickers SET Symbol = ? WHERE ID = ?",
+                             [(symbol, ticker_id) for ticker_id, symbol in symbols.items()])
+
+    # Keep the oldest row of every symbol and point the prices and articles of the others at it
+    kept, duplicates = {}, []
+    for ticker_id, symbol in symbols.items():
+        if symbol in kept:
+            duplicates.append((kept[symbol], ticker_id))
+        else:
+            kept[symbol] = ticker_id
+    for table, key in (("StockPrices", "Date"), ("Articles", "Title")):
+        if database.table_columns(cursor, table):
+            database.execute_batched(cursor, f"DELETE FROM {table} WHERE TickerID = ? AND {key} IN "
+                                             f"(SELECT {key} FROM {table} WHERE TickerID = ?)",
+                                     [(duplicate, keep) for keep, duplicate in duplicates])
+            database.execute_batched(cursor, f"UPDATE {table} SET TickerID = ? WHERE TickerID = ?", duplicates)
+    database.execute_batched(cursor, "DELETE FROM Tickers WHERE ID = ?", [(duplicate,) for _, duplicate in duplicates])
+
+    cursor.execute("ALTER TABLE Tickers DROP COLUMN TickerObject")
+    if not sqlite:
+        cursor.execute("ALTER TABLE Tickers ALTER COLUMN Symbol NVARCHAR(16) NOT NULL")
+    cursor.execute("CREATE UNIQUE INDEX UQ_Tickers_Symbol ON Tickers (Symbol)")
+    return len(duplicates)
+
+def _migrate_portfolios(cursor):
+    columns = database.table_columns(cursor, "OptimizedPortfolios")
+    if "CleanWeights" not in columns:
+        database.create_tables(cursor)
+        return 0
+    # PortfolioWeights references OptimizedPortfolios by ID, which the JSON layout did not need
+    if "ID" not in columns:
+        if database.DATABASE_BACKEND == "sqlite":
+            raise MigrationError("OptimizedPortfolios has no ID column")
+        cursor.execute("ALTER TABLE OptimizedPortfolios ADD ID INT IDENTITY NOT NULL")
+        cursor.execute("ALTER TABLE OptimizedPortfolios ADD CONSTRAINT PK_OptimizedPortfolios PRIMARY KEY (ID)")
+    database.create_tables(cursor)
+
+    cursor.execute("SELECT ID, CleanWeights FROM OptimizedPortfolios WHERE CleanWeights IS NOT NULL")
+    portfolio_weights = [(portfolio_id, json.loads(weights)) for portfolio_id, weights in cursor.fetchall()]
+    ticker_ids = database.ensure_ticker_ids(cursor, [ticker for _, weights in portfolio_weights for ticker in weights])
+    rows = [(portfolio_id, ticker_ids[ticker], float(weight))
+            for portfolio_id, weights in portfolio_weights for ticker, weight in weights.items()]
+    database.upsert_rows(cursor, "PortfolioWeights", ["PortfolioID", "TickerID"], ["Weight"], rows)
+    cursor.execute("ALTER TABLE OptimizedPortfolios DROP COLUMN CleanWeights")
+    return len(portfolio_weights)
+
+def migrate(connection):
+    """
+    Migrates the legacy tables in one transaction, the caller commits or rolls back.
+    Running it on a database already migrated changes nothing.
+    :return: dictionary with the number of merged ticker rows and of migrated portfolios
+    """
+    cursor = connection.cursor()
+    if database.DATABASE_BACKEND == "sqlite":
+        # Keep the DDL inside the transaction, sqlite3 only opens one implicitly before DML
+        cursor.execute("BEGIN")
+    merged_tickers = _migrate_tickers(cursor)
+    migrated_portfolios = _migrate_portfolios(cursor)
+    cursor.close()
+    return {"merged_tickers": merged_tickers, "migrated_portfolios": migrated_portfolios}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrates a database from the untyped layout to the typed schema")
+    parser.add_argument("--dry-run", action="store_true", help="roll the migration back after reporting what it changed")
+    args = parser.parse_args(argv)
+
+    # The pool refuses legacy databases, the migration uses its own connection
+    connection = database.connect_to_database()
+    try:
+        summary = migrate(connection)
+        if args.dry_run:
+            connection.rollback()
+        else:
+            connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    print(f"{'Dry run, rolled back: ' if args.dry_run else ''}merged {summary['merged_tickers']} duplicate ticker rows, "
+          f"moved the weights of {summary['migrated_portfolios']} portfolios")
+
+if __name__ == "__main__":
+    main()
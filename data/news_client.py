@@ -0,0 +1,118 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+NEWSAPI_URL = "https://newsapi.org/v2/top-headlines"
+
+class NewsClient:
+    """
+    Thread-pooled NewsAPI client sharing one pooled HTTP session between all requests.
+    :param api_key: NewsAPI key
+    :param base_url: headlines endpoint, can point to a local stand-in for tests
+    :param max_workers: maximum number of concurrent requests
+    :param timeout: (connect, read) timeout in seconds for a single request
+    :param retries: number of retries for connection errors and 429/5xx responses
+    :param backoff_factor: exponential backoff factor between retries
+    """
+    def __init__(self, api_key, base_url=NEWSAPI_URL, max_workers=8, timeout=(3.05, 10), retries=3, backoff_factor=0.5):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch_ticker_articles(self, ticker, n_articles, from_date, to_date):
+        """
+        Fetches the articles of one ticker.
+        :return: list of NewsAPI article dicts
+        """
+        params = {
+            "q": ticker,
+            "from": from_date,
+            "to": to_date,
+            "category": "business",
+            "pageSize": n_articles,
+            "apiKey": self.api_key,
+        }
+        response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        payload = response.json()
+        if payload.get("status") == "error":
+            raise RuntimeError(payload.get("message", "NewsAPI error"))
+        return payload["articles"]
+
+    def fetch_ticker(self, ticker, n_articles, from_date, to_date):
+        articles = pd.DataFrame(self.fetch_ticker_articles(ticker, n_articles, from_date, to_date))
+        articles["ticker"] = ticker
+        return articles
+
+    def _error_message(self, error):
+        # Keep the API key out of the error report, request URLs contain it
+        return str(error).replace(self.api_key, "***") if self.api_key else str(error)
+
+    def fetch(self, tickers, n_articles, from_date, to_date):
+        """
+        Fetches articles for every ticker concurrently. A failing ticker does not abort the others.
+        :return: DataFrame of all fetched articles and a dictionary of ticker -> error message
+        """
+        frames = {}
+        errors = {}
+        lock = threading.Lock()
+
+        def fetch_one(ticker):
+            try:
+                articles = self.fetch_ticker(ticker, n_articles, from_date, to_date)
+            except Exception as e:
+                with lock:
+                    errors[ticker] = self._error_message(e)
+            else:
+                with lock:
+                    frames[ticker] = articles
+
+        tickers = list(tickers)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(fetch_one, tickers))
+
+        # Concatenate once, in the requested ticker order
+        ordered = [frames[ticker] for ticker in tickers if ticker in frames]
+        articles = pd.concat(ordered, ignore_index=True) if ordered else pd.DataFrame()
+        return articles, errors
+
+    def iter_fetch(self, tickers, n_articles, from_date, to_date, errors=None):
+        """
+        Fetches articles ticker by ticker, yielding each ticker's articles in the requested order.
+        At most 2 * max_workers requests are in flight or waiting to be consumed, so memory does not
+        grow with the number of tickers.
+        :param errors: optional dictionary receiving ticker -> error message for the failing tickers
+        :return: generator of (ticker, list of NewsAPI article dicts)
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            tickers = iter(tickers)
+            while True:
+                for ticker in tickers:
+                    pending.append((ticker, executor.submit(self.fetch_ticker_articles, ticker, n_articles, from_date, to_date)))
+                    if len(pending) >= 2 * self.max_workers:
+                        break
+                if not pending:
+                    return
+                ticker, future = pending.popleft()
+                try:
+                    articles = future.result()
+                except Exception as e:
+                    if errors is not None:
+                        errors[ticker] = self._error_message(e)
+                    continue
+                yield ticker, articles
+
+    def close(self):
+        self.session.close()
@@ -1,71 +1,247 @@
 from . import config
-import requests
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from itertools import islice
 import pandas as pd
 from .database import load_articles, store_articles
-from transformers import BertTokenizer, BertForSequenceClassification
-from transformers import pipeline
+from .news_client import NewsClient, NEWSAPI_URL
+from .sentiment import get_sentiment_engine
+from .sentiment_cache import get_sentiment_cache
+from utils.metrics import metrics
 from datetime import datetime, timedelta
 
-def fetch_news_data(tickers, n_articles=1, load_from_database=False):
+_news_client = None
+_news_client_lock = threading.Lock()
+
+def get_news_client():
+    """
+    Returns the process-wide NewsClient, created on first use.
+    """
+    global _news_client
+    if _news_client is None:
+        with _news_client_lock:
+            if _news_client is None:
+                _news_client = NewsClient(config.NEWSAPI_KEY,  # NewsAPI key
+                                          base_url=getattr(config, "NEWSAPI_URL", NEWSAPI_URL),
+                                          max_workers=getattr(config, "NEWSAPI_MAX_WORKERS", 8))
+    return _news_client
+
+def fetch_news_data(tickers, n_articles=1, load_from_database=False, news_client=None):
     """
     Fetches news data for a list of stocks from the NewsAPI API.
+    Tickers are fetched concurrently, tickers that fail are reported in articles.attrs["errors"].
     :param tickers: list of stocks to fetch news data for
     :param n_articles: number of articles to fetch for each stock
     :param load_from_database: whether to load articles from database or fetch them from NewsAPI
+    :param news_client: NewsClient to fetch with, defaults to the process-wide client
     :return: dictionary of news data for each stock
     """
+    # Iterating a price frame yields its tickers, list them once so generators are not used up
+    tickers = list(tickers)
+    with metrics.timer("fetch_news_data", tickers=len(tickers), source="database" if load_from_database else "newsapi") as stage:
+        articles = _fetch_news_data(tickers, n_articles, load_from_database, news_client)
+        stage["articles"] = 0 if articles is None else len(articles)
+    return articles
 
-    API_KEY = config.NEWSAPI_KEY  # NewsAPI key
-
-    # Set up FinancialBERT model and tokenizer
-    model_name = config.FinancialBERT
-    tokenizer = BertTokenizer.from_pretrained(model_name)
-    model = BertForSequenceClassification.from_pretrained(model_name, num_labels=3)
-    
+def _fetch_news_data(tickers, n_articles, load_from_database, news_client):
     if load_from_database:
         # Load articles from database
         articles = load_articles()
     else:
         # Load articles from NewsAPI for each ticker symbol
-        articles = pd.DataFrame()
         today = datetime.today().strftime('%Y-%m-%d')
         month_ago = (datetime.today() - timedelta(days=30)).strftime('%Y-%m-%d')
-        for ticker in tickers:
-            try:
-                url = f"https://newsapi.org/v2/top-headlines?q={ticker}&from={month_ago}&to={today}&category=business&pageSize={n_articles}&apiKey={API_KEY}"
-                response = requests.get(url)
-                articles_ticker = pd.DataFrame(response.json()["articles"])
-                articles_ticker["ticker"] = ticker
-                articles = pd.concat([articles, articles_ticker], ignore_index=True)
-            except Exception as e:
-                print(f"Error fetching news data for {ticker}, reason - {e}")
-                return None
-
+        news_client = news_client or get_news_client()
+        articles, errors = news_client.fetch(tickers, n_articles, month_ago, today)
+        metrics.incr("news.errors", len(errors))
+        for ticker, error in errors.items():
+            print(f"Error fetching news data for {ticker}, reason - {error}")
+        if articles.empty:
+            return None
 
         # Pre-process articles
-        articles["text"] = articles["title"] + " " + articles["description"]
-        articles["text"] = articles["text"].str.lower()
-        articles["text"] = articles["text"].str.replace(r"[^\w\s]", "")
-        articles["text"] = articles["text"].str.replace(r"\d+", "")
-        articles["text"] = articles["text"].str.strip()
+        articles["text"] = normalize_text(articles["title"] + " " + articles["description"])
         articles = articles.drop_duplicates(subset=["text"]).dropna()
 
-        # Tokenize and prepare input for FinancialBERT model
-        nlp = pipeline(task="sentiment-analysis", model=model, tokenizer=tokenizer)
-        results = nlp(list(articles["text"]))
+        # Score the articles, only texts missing from the sentiment cache reach FinancialBERT
+        results = score_texts(list(articles["text"]))
 
         if results:
-            # Extract sentiment scores from the results
-            articles["sentiment"] = [result['score'] for result in results] # type: ignore
+            # Extract sentiment labels and scores from the results
+            articles["label"] = [result['label'] for result in results]
+            articles["sentiment"] = [result['score'] for result in results]
+        articles.attrs["errors"] = errors
 
         # Store articles in database
         # store_articles(articles)
 
     return articles
 
+# Number of article texts remembered for de-duplication by the streaming pipeline
+NEWS_DEDUPE_WINDOW = getattr(config, "NEWS_DEDUPE_WINDOW", 100_000)
+
+# Number of articles scored together by the streaming pipeline
+NEWS_SCORE_BATCH_SIZE = getattr(config, "NEWS_SCORE_BATCH_SIZE", 256)
+
+def stream_sentiment_scores(tickers, n_articles=1, news_client=None, batch_size=NEWS_SCORE_BATCH_SIZE,
+                            dedupe_window=NEWS_DEDUPE_WINDOW):
+    """
+    Streaming version of get_sentiment_scores(fetch_news_data(...)) for articles fetched from NewsAPI.
+    Articles flow one at a time through fetch -> normalize -> dedupe -> batched scoring -> per-ticker
+    running means, so memory is bounded by the batch size, the dedupe window and the number of tickers,
+    however many articles are fetched.
+    :param tickers: list of stocks to fetch news data for
+    :param n_articles: number of articles to fetch for each stock
+    :param news_client: NewsClient to fetch with, defaults to the process-wide client
+    :param batch_size: number of articles scored together
+    :param dedupe_window: number of recent texts remembered to drop duplicate articles
+    :return: dictionary of ticker -> mean signed sentiment, None if no article was scored
+    """
+    tickers = list(tickers)
+    with metrics.timer("stream_sentiment_scores", tickers=len(tickers)) as stage:
+        today = datetime.today().strftime('%Y-%m-%d')
+        month_ago = (datetime.today() - timedelta(days=30)).strftime('%Y-%m-%d')
+        news_client = news_client or get_news_client()
+        errors = {}
+        articles = iter_articles(news_client.iter_fetch(tickers, n_articles, month_ago, today, errors=errors))
+        sentiment = SentimentAccumulator()
+        sentiment.update(score_articles(deduplicate(articles, dedupe_window), batch_size))
+
+        metrics.incr("news.errors", len(errors))
+        for ticker, error in errors.items():
+            print(f"Error fetching news data for {ticker}, reason - {error}")
+        stage["articles"] = sentiment.count
+    return sentiment.scores()
+
+def iter_articles(fetched):
+    """
+    Normalizes fetched articles, skipping the ones without a title or description.
+    :param fetched: iterable of (ticker, list of NewsAPI article dicts), as yielded by NewsClient.iter_fetch
+    :return: generator of (ticker, normalized text)
+    """
+    for ticker, articles in fetched:
+        for article in articles:
+            title, description = article.get("title"), article.get("description")
+            if title is None or description is None:
+                continue
+            yield ticker, normalize_article_text(title + " " + description)
+
+def deduplicate(articles, window=NEWS_DEDUPE_WINDOW):
+    """
+    Drops articles whose text was already seen, keeping the first one like drop_duplicates.
+    Only the hashes of the last window distinct texts are remembered.
+    :param articles: iterable of (ticker, normalized text)
+    :return: generator of (ticker, normalized text)
+    """
+    seen = OrderedDict()
+    for ticker, text in articles:
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        if key in seen:
+            continue
+        seen[key] = None
+        if len(seen) > window:
+            seen.popitem(last=False)
+        yield ticker, text
+
+def score_articles(articles, batch_size=NEWS_SCORE_BATCH_SIZE, cache=None, engine=None):
+    """
+    Scores articles in batches with score_texts.
+    :param articles: iterable of (ticker, normalized text)
+    :return: generator of (ticker, {'label': ..., 'score': ...})
+    """
+    articles = iter(articles)
+    while True:
+        batch = list(islice(articles, batch_size))
+        if not batch:
+            return
+        results = score_texts([text for _, text in batch], cache=cache, engine=engine)
+        for (ticker, _), result in zip(batch, results):
+            yield ticker, result
+
+class SentimentAccumulator:
+    """
+    Running mean of the signed sentiment of each ticker's articles.
+    """
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+        self.count = 0
+
+    def add(self, ticker, result):
+        """
+        :param result: {'label': ..., 'score': ...} dict of one article
+        """
+        sentiment = LABEL_SIGNS.get(str(result["label"]).lower(), 0.0) * result["score"]
+        self.sums[ticker] = self.sums.get(ticker, 0.0) + sentiment
+        self.counts[ticker] = self.counts.get(ticker, 0) + 1
+        self.count += 1
+
+    def update(self, scored):
+        """
+        :param scored: iterable of (ticker, {'label': ..., 'score': ...})
+        """
+        for ticker, result in scored:
+            self.add(ticker, result)
+        return self
+
+    def scores(self):
+        if not self.count:
+            return None
+        return {ticker: self.sums[ticker] / self.counts[ticker] for ticker in sorted(self.sums)}
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_DIGITS = re.compile(r"\d+")
+
+def normalize_article_text(text):
+    """Normalizes one article text, like normalize_text."""
+    return _DIGITS.sub("", _PUNCTUATION.sub("", text.lower())).strip()
+
+def normalize_text(text):
+    """
+    Normalizes article texts: lowercase, without punctuation and digits.
+    :param text: Series of raw article texts
+    :return: Series of normalized texts
+    """
+    text = text.str.lower()
+    text = text.str.replace(r"[^\w\s]", "", regex=True)
+    text = text.str.replace(r"\d+", "", regex=True)
+    return text.str.strip()
+
+def score_texts(texts, cache=None, engine=None):
+    """
+    Scores normalized texts, reusing cached results and caching the new ones.
+    :param texts: list of normalized texts
+    :return: list of {'label': ..., 'score': ...} dicts, one per text
+    """
+    cache = cache or get_sentiment_cache()
+    results = cache.get_many(texts)
+    unseen = [text for text in dict.fromkeys(texts) if text not in results]
+    metrics.incr("sentiment.texts_cached", len(results))
+    metrics.incr("sentiment.texts_scored", len(unseen))
+    if unseen:
+        engine = engine or get_sentiment_engine()
+        scored = dict(zip(unseen, engine.score(unseen)))
+        cache.put_many(scored)
+        results.update(scored)
+    return [results[text] for text in texts]
+
+# Sign of each FinancialBERT label, neutral articles count as zero sentiment
+LABEL_SIGNS = {"positive": 1.0, "negative": -1.0, "neutral": 0.0}
+
+def signed_sentiment(articles):
+    """
+    Sentiment of each article in [-1, 1]: the classifier's score, signed by its label.
+    """
+    if "label" not in articles:
+        return articles["sentiment"]
+    signs = articles["label"].str.lower().map(LABEL_SIGNS).fillna(0.0)
+    return signs * articles["sentiment"]
+
 def get_sentiment_scores(articles):
     if articles is None:
         return None
-    # Aggregate sentiment scores by ticker symbol
-    sentiment_scores = articles.groupby("ticker")["sentiment"].mean().to_dict()
+    # Aggregate signed sentiment scores by ticker symbol
+    sentiment_scores = signed_sentiment(articles).groupby(articles["ticker"]).mean().to_dict()
     return sentiment_scores
\ No newline at end of file
@@ -0,0 +1,235 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from datetime import date
+import numpy as np
+import pandas as pd
+from utils.metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks, e.g. on Windows, writes are then only serialized within a process
+    fcntl = None
+
+# Columns are stored as one structured array, so dates and prices are always replaced together
+COLUMN_DTYPE = np.dtype([("date", "datetime64[D]"), ("price", np.float64)])
+
+# Calendar days re-downloaded on both sides of a gap, to check the stored prices still match
+OVERLAP_DAYS = 7
+# Relative difference between a stored and a re-downloaded price that means the adjustment changed
+ADJUSTMENT_TOLERANCE = 1e-5
+
+def yahoo_downloader(tickers, start_date, end_date):
+    """
+    Downloads adjusted close prices from Yahoo Finance.
+    Tickers without prices in the range, e.g. not listed yet, come back empty, other failures raise.
+    :param tickers: list of stocks to download
+    :param start_date: first date to download (inclusive)
+    :param end_date: last date to download (exclusive)
+    :return: DataFrame of prices indexed by date, one column per ticker
+    """
+    import yfinance as yf
+    prices = yf.download(list(tickers), start=start_date, end=end_date, auto_adjust=False, progress=False)['Adj Close']
+    # yfinance reports failures instead of raising, tell missing data apart from failed requests
+    errors = {ticker: str(error) for ticker, error in getattr(yf.shared, "_ERRORS", {}).items() if ticker in tickers}
+    failed = {ticker: error for ticker, error in errors.items() if "delisted" not in error and "No data found" not in error}
+    if failed:
+        raise RuntimeError(f"Yahoo Finance download failed: {failed}")
+    if isinstance(prices, pd.Series):
+        prices = prices.to_frame(tickers[0])
+    return prices
+
+def _to_day(value):
+    return np.datetime64(pd.Timestamp(value).date(), 'D')
+
+def _merge_spans(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def _missing_spans(spans, start, end):
+    # Walk the sorted, merged spans and collect the holes inside [start, end)
+    gaps = []
+    cursor = start
+    for span_start, span_end in spans:
+        if span_end <= cursor or span_start >= end:
+            continue
+        if span_start > cursor:
+            gaps.append((cursor, span_start))
+        cursor = max(cursor, span_end)
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+class PriceStore:
+    """
+    On-disk price cache with one memory-mapped NumPy column per ticker.
+    Every ticker keeps the list of [start, end) date spans already fetched, so a request
+    only downloads the gaps that are not on disk yet.
+    :param directory: directory holding the cached price columns
+    :param downloader: callable(tickers, start_date, end_date) returning a DataFrame of prices
+    """
+    def __init__(self, directory, downloader=yahoo_downloader):
+        self.directory = directory
+        self.downloader = downloader
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _write_lock(self):
+        # Serialize updates between threads, and between processes sharing the directory
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, ticker, suffix):
+        safe_ticker = "".join(c if c.isalnum() or c in "-_.^=" else "_" for c in ticker)
+        return os.path.join(self.directory, f"{safe_ticker}.{suffix}")
+
+    def spans(self, ticker):
+        """Returns the merged [start, end) spans stored for a ticker as datetime64[D] pairs."""
+        path = self._path(ticker, "spans.json")
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [[np.datetime64(start, 'D'), np.datetime64(end, 'D')] for start, end in json.load(f)]
+
+    def _load_column(self, ticker):
+        column_path = self._path(ticker, "column.npy")
+        if os.path.exists(column_path):
+            column = np.load(column_path, mmap_mode='r')
+            return column["date"], column["price"]
+        # Columns written before dates and prices shared one file
+        dates_path = self._path(ticker, "dates.npy")
+        if os.path.exists(dates_path):
+            return np.load(dates_path), np.load(self._path(ticker, "prices.npy"))
+        return np.empty(0, dtype='datetime64[D]'), np.empty(0, dtype=np.float64)
+
+    def _write(self, ticker, suffix, write):
+        # Write to a temporary file first so readers never see a half-written column
+        path = self._path(ticker, suffix)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+    def _store(self, ticker, new_prices, new_spans):
+        dates, prices = self._load_column(ticker)
+        new_dates = new_prices.index.values.astype('datetime64[D]')
+
+        # Merge the new observations in, newer downloads win on overlapping dates
+        all_dates = np.concatenate([new_dates, dates])
+        all_prices = np.concatenate([new_prices.to_numpy(dtype=np.float64), prices])
+        all_dates, first = np.unique(all_dates, return_index=True)
+        all_prices = all_prices[first]
+
+        column = np.empty(len(all_dates), dtype=COLUMN_DTYPE)
+        column["date"], column["price"] = all_dates, all_prices
+
+        # The column is replaced before the spans, so the spans never claim prices that are not on disk
+        spans = _merge_spans(self.spans(ticker) + [list(span) for span in new_spans])
+        self._write(ticker, "column.npy", lambda f: np.save(f, column))
+        self._write(ticker, "spans.json", lambda f: f.write(json.dumps([[str(s), str(e)] for s, e in spans]).encode()))
+        for suffix in ("dates.npy", "prices.npy"):
+            if os.path.exists(self._path(ticker, suffix)):
+                os.remove(self._path(ticker, suffix))
+
+    def update(self, tickers, start_date, end_date, _refreshing=False):
+        """
+        Downloads the parts of [start_date, end_date) that are not stored yet.
+        Tickers missing the same span are downloaded together in a single request.
+        Adjusted prices change retroactively with every dividend or split, so the days around each gap
+        are downloaded again, and a ticker whose stored prices no longer match is downloaded from scratch.
+        :return: number of download requests issued
+        """
+        start = _to_day(start_date)
+        # Never mark days that have not closed yet as fetched
+        end = min(_to_day(end_date), np.datetime64(date.today(), 'D'))
+        if start >= end:
+            return 0
+
+        with self._write_lock():
+            missing = {}
+            for ticker in tickers:
+                for gap in _missing_spans(self.spans(ticker), start, end):
+                    missing.setdefault(gap, []).append(ticker)
+
+            stale = []
+            for (gap_start, gap_end), gap_tickers in missing.items():
+                # Overlap the stored neighbours of the gap, they show whether Yahoo re-adjusted the history
+                download_start = gap_start - np.timedelta64(OVERLAP_DAYS, 'D')
+                download_end = min(gap_end + np.timedelta64(OVERLAP_DAYS, 'D'), np.datetime64(date.today(), 'D'))
+                metrics.incr("price_store.download_requests")
+                try:
+                    downloaded = self.downloader(gap_tickers, str(download_start), str(download_end))
+                except Exception as e:
+                    # Leave the span missing, the next request retries it
+                    metrics.incr("price_store.download_errors")
+                    print(f"Error downloading prices of {gap_tickers} from {gap_start} to {gap_end}, reason - {e}")
+                    continue
+                metrics.incr("price_store.rows_downloaded", len(downloaded))
+                for ticker in gap_tickers:
+                    column = downloaded[ticker].dropna() if ticker in downloaded else pd.Series(dtype=np.float64)
+                    if not self._matches_stored(ticker, column):
+                        stale.append(ticker)
+                        continue
+                    # An empty answer is recorded too, e.g. the days before a listing, so it is not downloaded again
+                    self._store(ticker, column, [(gap_start, gap_end)])
+
+            if stale and not _refreshing:
+                # A dividend or split re-adjusted the history, drop it and download it again as a whole
+                metrics.incr("price_store.readjusted_tickers", len(stale))
+                for ticker in stale:
+                    self._drop(ticker)
+        if stale and not _refreshing:
+            return len(missing) + self.update(stale, start_date, end_date, _refreshing=True)
+        return len(missing)
+
+    def _matches_stored(self, ticker, column):
+        # Compare the downloaded prices with the stored ones on the dates both have
+        dates, prices = self._load_column(ticker)
+        new_dates = column.index.values.astype('datetime64[D]')
+        common, stored_index, new_index = np.intersect1d(dates, new_dates, return_indices=True)
+        if not len(common):
+            return True
+        stored = np.asarray(prices)[stored_index]
+        return np.allclose(column.to_numpy(dtype=np.float64)[new_index], stored, rtol=ADJUSTMENT_TOLERANCE, atol=0.0)
+
+    def _drop(self, ticker):
+        for suffix in ("column.npy", "spans.json", "dates.npy", "prices.npy"):
+            if os.path.exists(self._path(ticker, suffix)):
+                os.remove(self._path(ticker, suffix))
+
+    def load(self, tickers, start_date, end_date):
+        """
+        Reads stored prices for [start_date, end_date) into a DataFrame, one column per ticker.
+        """
+        start, end = _to_day(start_date), _to_day(end_date)
+        columns = {}
+        for ticker in tickers:
+            dates, prices = self._load_column(ticker)
+            lo, hi = np.searchsorted(dates, [start, end])
+            columns[ticker] = pd.Series(np.array(prices[lo:hi]), index=pd.DatetimeIndex(dates[lo:hi], name="Date"))
+        stock_data = pd.DataFrame(columns)
+        stock_data.index.name = "Date"
+        return stock_data
+
+    def get(self, tickers, start_date, end_date):
+        """
+        Returns prices for [start_date, end_date), downloading only what is not stored yet.
+        """
+        self.update(tickers, start_date, end_date)
+        return self.load(tickers, start_date, end_date)
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import deque
+from . import config
+
+class SentimentEngine:
+    """
+    FinancialBERT sentiment classifier that is loaded once and shared by every request.
+    The model is loaded lazily on the first call, inference runs in fixed-size batches.
+    :param model_name: name or path of the pretrained sequence classification model
+    :param batch_size: number of texts scored per forward pass
+    :param max_length: maximum number of tokens per text, longer texts are truncated
+    """
+    def __init__(self, model_name, batch_size=32, max_length=128):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = None
+        self.model = None
+        self.batch_latencies = deque(maxlen=1000)
+        self.texts_scored = 0
+        self._load_lock = threading.Lock()
+        self._inference_lock = threading.Lock()
+
+    def load(self):
+        if self.model is None:
+            with self._load_lock:
+                if self.model is None:
+                    from transformers import BertTokenizer, BertForSequenceClassification
+                    self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
+                    model = BertForSequenceClassification.from_pretrained(self.model_name, num_labels=3)
+                    model.eval()
+                    self.model = model
+        return self
+
+    def score(self, texts):
+        """
+        Scores texts in batches.
+        :param texts: list of texts to classify
+        :return: list of {'label': ..., 'score': ...} dicts, one per text
+        """
+        import torch
+        self.load()
+        id2label = self.model.config.id2label
+        results = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = list(texts[start:start + self.batch_size])
+            batch_start = time.perf_counter()
+            with self._inference_lock, torch.inference_mode():
+                inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+                probabilities = torch.softmax(self.model(**inputs).logits, dim=-1)
+                scores, labels = probabilities.max(dim=-1)
+            self.batch_latencies.append(time.perf_counter() - batch_start)
+            self.texts_scored += len(batch)
+            results.extend({'label': id2label[label], 'score': score}
+                           for label, score in zip(labels.tolist(), scores.tolist()))
+        return results
+
+    def stats(self):
+        latencies = list(self.batch_latencies)
+        return {
+            "texts_scored": self.texts_scored,
+            "batches": len(latencies),
+            "mean_batch_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max_batch_latency": max(latencies, default=0.0),
+        }
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_sentiment_engine():
+    """
+    Returns the process-wide SentimentEngine, created on first use.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = SentimentEngine(config.FinancialBERT,
+                                          batch_size=getattr(config, "SENTIMENT_BATCH_SIZE", 32),
+                                          max_length=getattr(config, "SENTIMENT_MAX_LENGTH", 128))
+    return _engine
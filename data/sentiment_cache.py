@@ -0,0 +1,111 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from . import config
+
+def text_key(text, model=""):
+    """Content address of a normalized article text scored by the given model."""
+    return hashlib.sha1(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+class SentimentCache:
+    """
+    Persistent SQLite cache from normalized article text to its sentiment label and score.
+    The least recently used entries are evicted once the cache holds more than max_entries rows.
+    :param path: path of the SQLite database file
+    :param max_entries: maximum number of cached texts
+    :param model: identifier of the model scoring the texts, results of other models are never returned
+    """
+    def __init__(self, path, max_entries=100_000, model=""):
+        self.path = path
+        self.max_entries = max_entries
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS Sentiment (
+                Key TEXT PRIMARY KEY,
+                Label TEXT NOT NULL,
+                Score REAL NOT NULL,
+                LastUsed REAL NOT NULL
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS IX_Sentiment_LastUsed ON Sentiment (LastUsed)")
+        self._connection.commit()
+
+    def get_many(self, texts):
+        """
+        Looks up cached results.
+        :param texts: normalized texts
+        :return: dictionary of text -> {'label': ..., 'score': ...} for the texts found in the cache
+        """
+        keys = {text_key(text, self.model): text for text in texts}
+        found = {}
+        with self._lock:
+            key_list = list(keys)
+            # Stay well below SQLite's limit on bound parameters
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT Key, Label, Score FROM Sentiment WHERE Key IN ({placeholders})", chunk).fetchall()
+                for key, label, score in rows:
+                    found[keys[key]] = {'label': label, 'score': score}
+            if found:
+                now = time.time()
+                self._connection.executemany("UPDATE Sentiment SET LastUsed = ? WHERE Key = ?",
+                                             [(now, text_key(text, self.model)) for text in found])
+                self._connection.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, results):
+        """
+        Stores results and evicts the least recently used entries above max_entries.
+        :param results: dictionary of normalized text -> {'label': ..., 'score': ...}
+        """
+        now = time.time()
+        rows = [(text_key(text, self.model), result['label'], float(result['score']), now) for text, result in results.items()]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO Sentiment (Key, Label, Score, LastUsed) VALUES (?, ?, ?, ?)", rows)
+            excess = self._connection.execute("SELECT COUNT(*) FROM Sentiment").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM Sentiment WHERE Key IN (SELECT Key FROM Sentiment ORDER BY LastUsed LIMIT ?)", (excess,))
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute("SELECT COUNT(*) FROM Sentiment").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_sentiment_cache():
+    """
+    Returns the process-wide SentimentCache, created on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SentimentCache(getattr(config, "SENTIMENT_CACHE_PATH", "cache/sentiment.sqlite3"),
+                                        max_entries=getattr(config, "SENTIMENT_CACHE_MAX_ENTRIES", 100_000),
+                                        model=config.FinancialBERT)
+    return _cache
@@ -1,42 +1,218 @@
-import yfinance as yf
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from .database import store_tickers, load_tickers
+from . import config
+from .database import store_tickers, load_price_matrix
+from .price_store import PriceStore
+from utils.metrics import metrics
 
-def fetch_stock_data(tickers, start_date='2021-01-01', end_date='2022-01-01', load_from_database=False):
+_price_store = None
+_price_store_lock = threading.Lock()
+
+def get_price_store():
+    """
+    Returns the process-wide on-disk price store, created on first use.
+    """
+    global _price_store
+    if _price_store is None:
+        with _price_store_lock:
+            if _price_store is None:
+                _price_store = PriceStore(getattr(config, "PRICE_STORE_DIR", "cache/prices"))
+    return _price_store
+
+def fetch_stock_data(tickers, start_date='2021-01-01', end_date='2022-01-01', load_from_database=False, price_store=None):
     """
     Fetches stock data for a list of stocks from Yahoo Finance.
+    Prices already in the local price store are reused, only missing date ranges are downloaded.
     :param tickers: list of stocks to fetch data for
     :param start_date: start date for fetching data
     :param end_date: end date for fetching data
     :param load_from_database: whether to load tickers from database or fetch them from Yahoo Finance
+    :param price_store: PriceStore to read through, defaults to the process-wide store
     :return: dictionary of stock data for each stock
     """
-    if load_from_database:
-        # Load tickers from database
-        stock_data = load_tickers()
-    else:
-        # TODO: date range handling
-        stock_data = yf.download(tickers, start=start_date, end=end_date)['Adj Close']
-        # store_tickers(stock_data)
+    tickers = list(tickers)
+    with metrics.timer("fetch_stock_data", tickers=len(tickers), source="database" if load_from_database else "price_store") as stage:
+        if load_from_database:
+            # Load the requested prices from database
+            stock_data = load_price_matrix(tickers, start_date, end_date)
+        else:
+            price_store = price_store or get_price_store()
+            stock_data = price_store.get(tickers, start_date, end_date)
+            # store_tickers(stock_data)
+        stage["rows"] = len(stock_data)
     return stock_data
 
-def select_low_correlation_stocks(stock_data, n_stocks=100):
-    # Calculate the correlation matrix
-    corr_matrix = stock_data.corr()
+def _column_blocks(n_columns, chunk_size):
+    return [np.arange(start, min(start + chunk_size, n_columns)) for start in range(0, n_columns, chunk_size)]
+
+def _prepare_correlation_inputs(stock_data):
+    # Standardize every column over its own observations, missing values become zeros that the
+    # masks leave out of each pair's sums
+    values = stock_data.to_numpy(dtype=np.float32, na_value=np.nan)
+    mask = ~np.isnan(values)
+    counts = np.maximum(mask.sum(axis=0), 1).astype(np.float32)
+    values = np.where(mask, values, np.float32(0))
+    mean = values.sum(axis=0) / counts
+    values = np.where(mask, values - mean, np.float32(0))
+    scale = np.sqrt((values ** 2).sum(axis=0) / counts)
+    values /= np.where(scale > 0, scale, 1).astype(np.float32)
+    # Squared once here instead of once per block
+    return values, mask.astype(np.float32), values * values
+
+def _pairwise_correlation(values, mask, squares, columns, min_periods=2):
+    """
+    Correlations between the given columns and every column, each pair computed over the
+    rows where both columns have a value, like DataFrame.corr.
+    :param squares: values * values, from _prepare_correlation_inputs
+    :return: (len(columns), n_columns) float32 array, NaN for pairs with fewer than min_periods rows
+    """
+    x, x_mask = values[:, columns], mask[:, columns]
+    n = x_mask.T @ mask
+    sum_x = x.T @ mask
+    sum_y = x_mask.T @ values
+    sum_xx = squares[:, columns].T @ mask
+    sum_yy = x_mask.T @ squares
+    sum_xy = x.T @ values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = n * sum_xy - sum_x * sum_y
+        var = (n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2)
+        corr = np.clip(cov / np.sqrt(var), -1, 1)
+    corr[(n < min_periods) | ~(var > 0)] = np.nan
+    return corr
+
+def mean_correlations(stock_data, chunk_size=512, max_workers=None, min_periods=2):
+    """
+    Mean pairwise-complete correlation of every column with all columns.
+    The correlation matrix is computed in float32 blocks of chunk_size rows, optionally on a
+    thread pool, so memory stays at O(chunk_size * n_columns) per worker instead of O(n_columns^2).
+    :param stock_data: DataFrame with one column per ticker, may contain missing values
+    :param chunk_size: number of tickers per block
+    :param max_workers: number of threads computing blocks, 1 computes them in this thread
+    :param min_periods: minimum number of overlapping observations for a pair to count
+    :return: Series of mean correlations sorted in ascending order
+    """
+    values, mask, squares = _prepare_correlation_inputs(stock_data)
+
+    def block_means(columns):
+        corr = _pairwise_correlation(values, mask, squares, columns, min_periods)
+        return np.nanmean(corr, axis=1) if corr.size else np.empty(0)
+
+    blocks = _column_blocks(values.shape[1], chunk_size)
+    if max_workers == 1 or len(blocks) == 1:
+        means = [block_means(columns) for columns in blocks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            means = list(executor.map(block_means, blocks))
+    means = np.concatenate(means) if means else np.empty(0)
+    return pd.Series(means, index=stock_data.columns).sort_values()
+
+def select_low_correlation_stocks(stock_data, n_stocks=100, method="mean", chunk_size=512, max_workers=None):
+    """
+    Selects the n_stocks tickers least correlated with the rest of the universe.
+    :param stock_data: DataFrame with one column per ticker, may contain missing values
+    :param n_stocks: number of tickers to select
+    :param method: "mean" picks the tickers with the lowest mean correlation, "greedy" starts from
+                   the lowest one and repeatedly adds the ticker least correlated with those already picked
+    :param chunk_size: number of tickers per correlation block
+    :param max_workers: number of threads computing correlation blocks
+    :return: list of selected tickers
+    """
+    mean_corr = mean_correlations(stock_data, chunk_size, max_workers)
+    if method == "mean":
+        return mean_corr.head(n_stocks).index.tolist()
+    if method != "greedy":
+        raise ValueError(f"Unknown selection method: {method}")
+
+    values, mask, squares = _prepare_correlation_inputs(stock_data)
+    position = stock_data.columns.get_indexer(mean_corr.index[:1])
+    selected = [int(position[0])] if len(position) else []
+    # Running sum of each ticker's correlation with the selected tickers, one column is added per pick
+    corr_sum = np.zeros(values.shape[1], dtype=np.float64)
+    available = np.ones(values.shape[1], dtype=bool)
+    while selected and len(selected) < min(n_stocks, values.shape[1]):
+        last = selected[-1]
+        available[last] = False
+        corr_sum += np.nan_to_num(_pairwise_correlation(values, mask, squares, [last])[0], nan=1.0)
+        selected.append(int(np.argmin(np.where(available, corr_sum, np.inf))))
+    return stock_data.columns[selected[:n_stocks]].tolist()
+
+def _to_float_array(stock_data):
+    # Numeric frames are converted in one block, other columns are coerced and counted
+    if all(pd.api.types.is_numeric_dtype(dtype) for dtype in stock_data.dtypes):
+        return stock_data.to_numpy(dtype=np.float64, na_value=np.nan, copy=True), 0
+    values = np.empty(stock_data.shape, dtype=np.float64)
+    coerced = 0
+    for i, (_, column) in enumerate(stock_data.items()):
+        numeric = pd.to_numeric(column, errors="coerce")
+        coerced += int(numeric.isna().sum() - column.isna().sum())
+        values[:, i] = numeric.to_numpy(dtype=np.float64, na_value=np.nan)
+    return values, coerced
+
+def preprocess_data(stock_data, ffill_limit=0, min_coverage=None, ragged_start=False, return_report=False):
+    """
+    Aligns a price frame for the optimizers in one vectorized pass.
+    Every ticker starts at its first price, so a recently listed ticker no longer truncates
+    the history of the others unless they are aligned on a common start.
+    :param stock_data: DataFrame of prices, one column per ticker
+    :param ffill_limit: maximum number of consecutive missing prices filled with the last known price,
+                        None fills every gap
+    :param min_coverage: minimum fraction of rows a ticker needs prices for to be kept, None keeps every ticker
+                         with at least one price
+    :param ragged_start: whether tickers keep their own start date, leaving missing prices before it.
+                         The returns are then handled pairwise by MarketStatistics. Otherwise the rows before the
+                         latest start date are dropped
+    :param return_report: whether to also return a dict counting what each rule removed
+    :return: cleaned DataFrame, and the report when return_report is set
+    """
+    values, coerced = _to_float_array(stock_data)
+    n_rows, n_tickers = values.shape
+    positions = np.arange(n_rows)[:, None]
+    valid = ~np.isnan(values)
+    first_valid = np.where(valid.any(axis=0), valid.argmax(axis=0), n_rows)
 
-    # Find the tickers with the lowest average correlation
-    mean_correlations = corr_matrix.mean().sort_values()
+    # Forward fill gaps of at most ffill_limit prices from the last valid row of each ticker
+    filled = 0
+    if ffill_limit is None or ffill_limit > 0:
+        last_valid = np.maximum.accumulate(np.where(valid, positions, -1), axis=0)
+        fill = ~valid & (last_valid >= 0)
+        if ffill_limit is not None:
+            fill &= positions - last_valid <= ffill_limit
+        if fill.any():
+            rows, columns = np.nonzero(fill)
+            values[rows, columns] = values[last_valid[rows, columns], columns]
+            valid |= fill
+            filled = len(rows)
 
-    # Select the top n_stocks with the lowest correlation
-    low_correlation_stocks = mean_correlations.head(n_stocks).index.tolist()
+    # Drop tickers with too few prices
+    coverage = valid.sum(axis=0) / max(n_rows, 1)
+    keep_tickers = coverage > 0
+    if min_coverage is not None:
+        keep_tickers &= coverage >= min_coverage
 
-    return low_correlation_stocks
+    # Drop the rows before the common start date, then the rows with gaps left in a started ticker
+    keep_rows = np.ones(n_rows, dtype=bool)
+    if not ragged_start and keep_tickers.any():
+        keep_rows &= positions[:, 0] >= first_valid[keep_tickers].max()
+    before_start = int(n_rows - keep_rows.sum())
+    gaps = (~valid & (positions >= first_valid))[:, keep_tickers].any(axis=1)
+    with_gaps = int((gaps & keep_rows).sum())
+    keep_rows &= ~gaps
 
-def preprocess_data(stock_data):
-    # Drop any rows with missing values
-    stock_data = stock_data.dropna()
-    
-    # Ensure all data types are numeric
-    stock_data = stock_data.apply(pd.to_numeric, errors="coerce")
-    
-    return stock_data
\ No newline at end of file
+    clean = pd.DataFrame(values[np.ix_(keep_rows, keep_tickers)], index=stock_data.index[keep_rows],
+                         columns=stock_data.columns[keep_tickers])
+    if not return_report:
+        return clean
+    report = {
+        "rows": n_rows,
+        "tickers": n_tickers,
+        "coerced_values": coerced,
+        "filled_values": filled,
+        "dropped_tickers": stock_data.columns[~keep_tickers].tolist(),
+        "rows_before_start": before_start,
+        "rows_with_gaps": with_gaps,
+        "rows_kept": int(keep_rows.sum()),
+        "tickers_kept": int(keep_tickers.sum()),
+    }
+    return clean, report
@@ -0,0 +1,20 @@
+import os
+
+# Import the app in the master process and warm it up before forking, so every worker starts
+# with the pipeline dependencies already imported and shares those pages copy-on-write
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+# Also load FinancialBERT in the master, only safe with a fork-friendly torch build
+warm_up_sentiment_model = os.environ.get("WARM_UP_SENTIMENT_MODEL", "0") == "1"
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+def when_ready(server):
+    # Runs in the master after the app was preloaded, right before the workers are forked
+    if preload_app:
+        from main import warm_up
+        warm_up(load_sentiment_model=warm_up_sentiment_model)
+
+def post_worker_init(worker):
+    from utils.metrics import log_event, memory_usage
+    log_event("worker_ready", pid=os.getpid(), preloaded=preload_app, **memory_usage())
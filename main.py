@@ -1,34 +1,127 @@
-from data.stock_data import fetch_stock_data, select_low_correlation_stocks, preprocess_data
-from data.news_data import fetch_news_data, get_sentiment_scores
+import hashlib
+import json
+import time
 
-from data.database import load_all_optimized_portfolios
+from data import config
 
-from optimization_models.PortfolioOptimizer import PortfolioOptimizer
-from optimization_models.risk_tolerance import optimize_portfolio_risk_tolerance, calculate_risk_tolerance
+# The pipeline stages (pandas, pypfopt, cvxpy, plotly, ...) are imported by run_pipeline or warm_up,
+# so importing this module to serve the web app stays cheap
+from utils.cache import LRUCache, DiskCache, TieredCache
+from utils.metrics import metrics, current_run, log_event, memory_usage, SamplingProfiler
 
-from utils.plot_utils import plot_portfolios
+# Bump whenever a change to the pipeline alters its output, so stale cached results are not served
+PIPELINE_VERSION = "6"
 
-def whole_pipeline(selected_companies, start_date, end_date):
+# Number of low-correlation tickers the optimizers keep, None optimizes every selected ticker
+SELECTION_N_STOCKS = getattr(config, "SELECTION_N_STOCKS", None)
+
+# Missing price handling, see preprocess_data
+PREPROCESS_FFILL_LIMIT = getattr(config, "PREPROCESS_FFILL_LIMIT", 5)
+PREPROCESS_MIN_COVERAGE = getattr(config, "PREPROCESS_MIN_COVERAGE", 0.8)
+
+PIPELINE_CACHE_TTL = getattr(config, "PIPELINE_CACHE_TTL", 15 * 60)
+# Optional SQLite file shared by all gunicorn workers, None keeps results in-process only
+PIPELINE_CACHE_PATH = getattr(config, "PIPELINE_CACHE_PATH", None)
+
+pipeline_cache = TieredCache(
+    LRUCache(maxsize=getattr(config, "PIPELINE_CACHE_SIZE", 128), ttl=PIPELINE_CACHE_TTL),
+    DiskCache(PIPELINE_CACHE_PATH, maxsize=getattr(config, "PIPELINE_DISK_CACHE_SIZE", 1024), ttl=PIPELINE_CACHE_TTL)
+    if PIPELINE_CACHE_PATH else None,
+)
+
+def pipeline_cache_key(selected_companies, start_date, end_date, age, financial_state, risk_aversion, n_stocks=SELECTION_N_STOCKS):
+    key = {
+        "tickers": sorted(set(selected_companies)),
+        "start_date": str(start_date),
+        "end_date": str(end_date),
+        "risk_profile": [age, financial_state, risk_aversion],
+        "n_stocks": n_stocks,
+        "version": PIPELINE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def whole_pipeline(selected_companies, start_date, end_date, age=35, financial_state=0.5, risk_aversion=0.5, use_cache=True,
+                   n_stocks=SELECTION_N_STOCKS, profile=False):
+    """
+    Runs the whole pipeline and returns the chart of the optimized portfolios.
+    Results are memoized on the ticker set, the date range and the risk profile.
+    Every stage is timed into utils.metrics, with profile the run is also sampled by a SamplingProfiler.
+    """
+    key = pipeline_cache_key(selected_companies, start_date, end_date, age, financial_state, risk_aversion, n_stocks)
+    token = current_run.set(key[:12])
+    try:
+        with metrics.timer("pipeline", tickers=len(selected_companies)) as stage:
+            graph_data = pipeline_cache.get(key) if use_cache else None
+            stage["cache_hit"] = graph_data is not None
+            metrics.incr("pipeline.cache_hits" if graph_data is not None else "pipeline.runs")
+            if graph_data is None:
+                if profile:
+                    with SamplingProfiler() as profiler:
+                        graph_data = run_pipeline(selected_companies, start_date, end_date, age, financial_state, risk_aversion, n_stocks)
+                    metrics.last_profile = profiler.report()
+                    log_event("profile", **metrics.last_profile)
+                else:
+                    graph_data = run_pipeline(selected_companies, start_date, end_date, age, financial_state, risk_aversion, n_stocks)
+                if use_cache:
+                    pipeline_cache.put(key, graph_data)
+    finally:
+        current_run.reset(token)
+    return graph_data
+
+def warm_up(load_sentiment_model=False):
+    """
+    Imports every dependency of the pipeline ahead of the first request.
+    Called in the gunicorn master before forking, the workers share the imported modules copy-on-write.
+    :param load_sentiment_model: whether to also load FinancialBERT
+    """
+    start = time.perf_counter()
+    import data.stock_data, data.news_data, data.price_store
+    import optimization_models.PortfolioOptimizer, optimization_models.frontier, optimization_models.risk_tolerance
+    import utils.plot_utils
+    # Imported lazily by pypfopt's CovarianceShrinkage and the price store
+    import sklearn.covariance
+    try:
+        import yfinance
+    except ImportError:
+        pass
+    if load_sentiment_model:
+        from data.sentiment import get_sentiment_engine
+        get_sentiment_engine().load()
+    log_event("warm_up", seconds=round(time.perf_counter() - start, 6), sentiment_model=load_sentiment_model, **memory_usage())
+
+def run_pipeline(selected_companies, start_date, end_date, age=35, financial_state=0.5, risk_aversion=0.5, n_stocks=None):
+    from data.stock_data import fetch_stock_data, select_low_correlation_stocks, preprocess_data
+    from data.news_data import stream_sentiment_scores
+    from optimization_models.PortfolioOptimizer import PortfolioOptimizer
+    from optimization_models.frontier import EfficientFrontierEngine
+    from optimization_models.risk_tolerance import calculate_risk_tolerance
+    from utils.plot_utils import plot_portfolios
 
     stock_data = fetch_stock_data(selected_companies, start_date, end_date, load_from_database=False)
 
-    # Select the top low-correlation stocks
-    # low_correlation_stocks = select_low_correlation_stocks(stock_data, n_stocks=10)
+    if n_stocks is not None and len(stock_data.columns) > n_stocks:
+        # Select the top low-correlation stocks
+        low_correlation_stocks = select_low_correlation_stocks(stock_data, n_stocks=n_stocks)
 
-    # Fetch stock data for the low-correlation stocks
-    # stock_data = fetch_stock_data(low_correlation_stocks)
+        # Fetch stock data for the low-correlation stocks, served from the price store
+        stock_data = fetch_stock_data(low_correlation_stocks, start_date, end_date, load_from_database=False)
 
-    # Fetch news data for the low-correlation stocks
-    news_data = fetch_news_data(stock_data, n_articles=10, load_from_database=False)
-    sentiment_scores = get_sentiment_scores(news_data)
+    # Fetch and score news for the low-correlation stocks, article by article
+    sentiment_scores = stream_sentiment_scores(stock_data.columns, n_articles=10)
 
     # preprocess_data.py
-    clean_stock_data = preprocess_data(stock_data)
-    risk_tolerance = calculate_risk_tolerance(35, 0.5, 0.5)
+    clean_stock_data, report = preprocess_data(stock_data, ffill_limit=PREPROCESS_FFILL_LIMIT,
+                                               min_coverage=PREPROCESS_MIN_COVERAGE, return_report=True)
+    print(f"Preprocessing kept {report['rows_kept']}/{report['rows']} rows and {report['tickers_kept']}/{report['tickers']} tickers "
+          f"(filled {report['filled_values']} prices, dropped tickers: {report['dropped_tickers']}, "
+          f"{report['rows_before_start']} rows before the common start, {report['rows_with_gaps']} rows with gaps)")
+    risk_tolerance = calculate_risk_tolerance(age, financial_state, risk_aversion)
 
     # optimize_portfolios.py
-    port_opt = PortfolioOptimizer(clean_stock_data, risk_tolerance)
-    portfolios = port_opt.optimize("all")
+    port_opt = PortfolioOptimizer(clean_stock_data, risk_tolerance, news_sentiment_scores=sentiment_scores)
+    with metrics.timer("optimize_all") as stage:
+        portfolios = port_opt.optimize("all")
+        stage["portfolios"] = len(portfolios)
 
     # [portfolio.save() for portfolio in portfolios]
 
@@ -40,5 +133,10 @@ def whole_pipeline(selected_companies, start_date, end_date):
     # print_weights.py
     [print(f"{portfolio.name.title()} weights: {weights}") for portfolio, weights in zip(portfolios, weights)]
 
+    # Trace the efficient frontier behind the optimized portfolios
+    with metrics.timer("efficient_frontier") as stage:
+        frontier = EfficientFrontierEngine.from_market_statistics(port_opt.market_stats).sweep(n_points=100)
+        stage["solved"] = int(frontier.solved.sum())
+
     # plot_portfolios.py
-    return plot_portfolios(portfolios)
\ No newline at end of file
+    return plot_portfolios(portfolios, frontier)
\ No newline at end of file
@@ -1,15 +1,96 @@
-from pypfopt import expected_returns, CovarianceShrinkage
-from pypfopt import BlackLittermanModel, EfficientFrontier, HRPOpt
+import json
+import multiprocessing
+import time
+from collections import OrderedDict
+from multiprocessing.connection import wait
+import numpy as np
+import pandas as pd
+from pypfopt import BlackLittermanModel, EfficientFrontier
 from pypfopt import exceptions
+from data import config
 from data.database import store_optimized_portfolio, load_optimized_portfolio, load_all_optimized_portfolios
+from .market_statistics import get_market_statistics
+from .hrp import HierarchicalRiskParity
+from .views import sentiment_views
+from utils.metrics import metrics, log_event
+
+MODELS = ("mean-variance", "black-litterman", "hrp")
+# Worker processes used by optimize("all"), 1 runs the models one after another in the calling process
+OPTIMIZER_WORKERS = getattr(config, "OPTIMIZER_WORKERS", len(MODELS))
+# Seconds optimize("all") waits for the models before giving up on the ones still running
+OPTIMIZER_TIMEOUT = getattr(config, "OPTIMIZER_TIMEOUT", 120.0)
+# How the model processes are started. They are started from job threads of a gunicorn worker that may
+# have torch loaded, so they are not forked from it by default
+OPTIMIZER_START_METHOD = getattr(config, "OPTIMIZER_START_METHOD",
+                                 "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+def _get_context():
+    context = multiprocessing.get_context(OPTIMIZER_START_METHOD)
+    if OPTIMIZER_START_METHOD == "forkserver":
+        # Model processes fork from a server that already imported the models
+        context.set_forkserver_preload([__name__])
+    return context
+
+def _run_model(connection, optimizer, model):
+    # Runs in a model process, sends ("ok", portfolio) or ("error", message) back to the parent
+    try:
+        result = ("ok", optimizer.optimize(model))
+    except Exception as e:
+        result = ("error", str(e))
+    connection.send(result)
+    connection.close()
+
+def _record(model, portfolio):
+    # Stage timing and solver status of an optimized portfolio, pool workers leave it to the parent process
+    if multiprocessing.parent_process() is not None:
+        return portfolio
+    metrics.observe(f"optimize.{model}", portfolio.wall_time)
+    metrics.incr(f"optimize.{model}.status.{portfolio.solver_status}")
+    log_event("stage", stage=f"optimize.{model}", seconds=round(portfolio.wall_time, 6), status="ok",
+              solver_status=portfolio.solver_status)
+    return portfolio
 
 class OptimizedPortfolio:
-    def __init__(self, name, clean_weights, expected_returns, volatility, sharpe_ratio):
+    """
+    An optimized portfolio: its name, weights and performance.
+    Weights are kept as a float64 array over a ticker Index, which can be views into the matrix
+    and index of a PortfolioSet, so many portfolios over one universe share their storage.
+    clean_weights still returns the ticker -> weight mapping.
+    """
+    __slots__ = ("name", "weights", "tickers", "expected_returns", "volatility", "sharpe_ratio", "wall_time", "solver_status")
+
+    def __init__(self, name, clean_weights, expected_returns, volatility, sharpe_ratio, wall_time=None, solver_status=None):
         self.name = name
-        self.clean_weights = clean_weights
+        clean_weights = pd.Series(clean_weights, dtype=np.float64)
+        self.tickers = clean_weights.index
+        self.weights = clean_weights.to_numpy()
         self.expected_returns = expected_returns
         self.volatility = volatility
         self.sharpe_ratio = sharpe_ratio
+        # Seconds it took to optimize the portfolio
+        self.wall_time = wall_time
+        # Status reported by the convex solver, None for models without one
+        self.solver_status = solver_status
+
+    @classmethod
+    def from_weights(cls, name, weights, tickers, expected_returns, volatility, sharpe_ratio, wall_time=None, solver_status=None):
+        """
+        Builds a portfolio on an existing weight array and ticker Index, without copying either.
+        """
+        portfolio = cls.__new__(cls)
+        portfolio.name = name
+        portfolio.weights = weights
+        portfolio.tickers = tickers
+        portfolio.expected_returns = expected_returns
+        portfolio.volatility = volatility
+        portfolio.sharpe_ratio = sharpe_ratio
+        portfolio.wall_time = wall_time
+        portfolio.solver_status = solver_status
+        return portfolio
+
+    @property
+    def clean_weights(self):
+        return OrderedDict(zip(self.tickers, self.weights.tolist()))
 
     def __iter__(self):
         yield self.name
@@ -24,7 +105,8 @@ class OptimizedPortfolio:
     @classmethod
     def from_portfolio(cls, portfolio):
         if isinstance(portfolio, OptimizedPortfolio):
-            return cls(portfolio.name, portfolio.clean_weights, portfolio.expected_returns, portfolio.volatility, portfolio.sharpe_ratio)
+            return cls.from_weights(portfolio.name, portfolio.weights, portfolio.tickers, portfolio.expected_returns,
+                                    portfolio.volatility, portfolio.sharpe_ratio)
         else:
             return cls(portfolio[0], portfolio[1], portfolio[2], portfolio[3], portfolio[4])
 
@@ -34,25 +116,197 @@ class OptimizedPortfolio:
         if optimized_portfolio is not None:
             return cls(*optimized_portfolio)
 
+class PortfolioSet:
+    """
+    Many portfolios over one ticker universe, stored column-wise.
+    Weights are one (portfolios, tickers) float64 matrix and the ticker Index is shared, so the
+    portfolios handed out by indexing or iteration are views and cost no copy.
+    :param tickers: ticker Index shared by every portfolio
+    :param weights: (portfolios, tickers) array of weights
+    :param expected_returns: (portfolios,) array of expected returns
+    :param volatility: (portfolios,) array of volatilities
+    :param sharpe_ratio: (portfolios,) array of Sharpe ratios
+    :param names: optional sequence of portfolio names, defaults to "<name_prefix> <i>"
+    """
+    __slots__ = ("tickers", "weights", "expected_returns", "volatility", "sharpe_ratio", "names", "name_prefix")
+
+    def __init__(self, tickers, weights, expected_returns, volatility, sharpe_ratio, names=None, name_prefix="Portfolio"):
+        self.tickers = pd.Index(tickers)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.expected_returns = np.asarray(expected_returns, dtype=np.float64)
+        self.volatility = np.asarray(volatility, dtype=np.float64)
+        self.sharpe_ratio = np.asarray(sharpe_ratio, dtype=np.float64)
+        self.names = names
+        self.name_prefix = name_prefix
+
+    @classmethod
+    def from_portfolios(cls, portfolios, tickers=None):
+        """
+        Stacks OptimizedPortfolio objects, tickers missing from a portfolio get a zero weight.
+        """
+        portfolios = list(portfolios)
+        if tickers is None:
+            tickers = pd.Index([])
+            for portfolio in portfolios:
+                tickers = tickers.union(portfolio.tickers, sort=False)
+        tickers = pd.Index(tickers)
+        weights = np.zeros((len(portfolios), len(tickers)))
+        for i, portfolio in enumerate(portfolios):
+            weights[i, tickers.get_indexer(portfolio.tickers)] = portfolio.weights
+        return cls(tickers, weights,
+                   [portfolio.expected_returns for portfolio in portfolios],
+                   [portfolio.volatility for portfolio in portfolios],
+                   [portfolio.sharpe_ratio for portfolio in portfolios],
+                   names=[portfolio.name for portfolio in portfolios])
+
+    def __len__(self):
+        return len(self.weights)
+
+    def name(self, i):
+        return self.names[i] if self.names is not None else f"{self.name_prefix} {i}"
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return OptimizedPortfolio.from_weights(self.name(i), self.weights[i], self.tickers, float(self.expected_returns[i]),
+                                               float(self.volatility[i]), float(self.sharpe_ratio[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_frame(self):
+        """Weights as a DataFrame, one row per portfolio, sharing the weight matrix."""
+        index = self.names if self.names is not None else None
+        return pd.DataFrame(self.weights, index=index, columns=self.tickers, copy=False)
+
+    def performance_frame(self):
+        return pd.DataFrame({"expected_returns": self.expected_returns, "volatility": self.volatility,
+                             "sharpe_ratio": self.sharpe_ratio}, index=self.names, copy=False)
+
+    def to_arrow(self):
+        """
+        Arrow table with the performance columns and a fixed-size list column of weights.
+        The weight column wraps the weight matrix buffer without copying, the tickers are kept in the schema metadata.
+        Requires pyarrow.
+        """
+        import pyarrow as pa
+        weights = np.ascontiguousarray(self.weights)
+        values = pa.Array.from_buffers(pa.float64(), weights.size, [None, pa.py_buffer(weights)])
+        columns = {
+            "expected_returns": pa.array(self.expected_returns),
+            "volatility": pa.array(self.volatility),
+            "sharpe_ratio": pa.array(self.sharpe_ratio),
+            "weights": pa.FixedSizeListArray.from_arrays(values, len(self.tickers)),
+        }
+        if self.names is not None:
+            columns = {"name": pa.array(list(self.names), pa.string()), **columns}
+        table = pa.table(columns)
+        return table.replace_schema_metadata({"tickers": json.dumps([str(ticker) for ticker in self.tickers])})
+
 class PortfolioOptimizer:
-    def __init__(self, stock_data, risk_tolerance=1.0, news_sentiment_scores=None):
+    def __init__(self, stock_data, risk_tolerance=1.0, news_sentiment_scores=None, max_workers=OPTIMIZER_WORKERS, timeout=OPTIMIZER_TIMEOUT, market_stats=None):
         self.stock_data = stock_data
         self.news_sentiment_scores = news_sentiment_scores
         self.risk_tolerance = risk_tolerance
+        self.max_workers = max_workers
+        self.timeout = timeout
+        # Returns, covariances and expected returns shared by every model
+        self.market_stats = market_stats if market_stats is not None else get_market_statistics(stock_data)
 
     def optimize(self, model):
         match model.lower():
             case "mean-variance":
-                return self.optimize_mean_variance()
+                return self._timed("mean-variance", self.optimize_mean_variance)
             case "black-litterman":
-                return self.optimize_black_litterman()
+                return self._timed("black-litterman", self.optimize_black_litterman)
             case "hrp":
-                return self.optimize_hrp()
+                return self._timed("hrp", self.optimize_hrp)
             case "all":
-                return [self.optimize_mean_variance(), self.optimize_black_litterman(), self.optimize_hrp()]
+                return self.optimize_all()
             case _:
                 raise ValueError("Invalid optimization model")
 
+    @staticmethod
+    def _timed(model, optimize_model):
+        start = time.perf_counter()
+        try:
+            portfolio = optimize_model()
+        except Exception:
+            metrics.incr(f"optimize.{model}.errors")
+            raise
+        portfolio.wall_time = time.perf_counter() - start
+        return _record(model, portfolio)
+
+    def optimize_all(self):
+        """
+        Runs every model, concurrently in up to max_workers processes when max_workers > 1.
+        A model that fails or does not finish within the timeout is reported and left out.
+        :return: list of the OptimizedPortfolio objects that were found
+        """
+        if self.max_workers is not None and self.max_workers <= 1:
+            portfolios = []
+            for model in MODELS:
+                try:
+                    portfolios.append(self.optimize(model))
+                except Exception as e:
+                    print(f"Error optimizing the {model} portfolio, reason - {e}")
+            return portfolios
+
+        # Compute the shared statistics once here, the model processes receive them with the optimizer
+        stats = self.market_stats
+        stats.returns, stats.shrunk_cov, stats.mean_historical_return, stats.capm_return
+
+        # Every call runs its models in processes of its own, so a timed out solve can be killed
+        # without touching the models of concurrent requests
+        context = _get_context()
+        max_workers = self.max_workers or len(MODELS)
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        waiting = list(MODELS)
+        running = {}
+        results = {}
+        while waiting or running:
+            while waiting and len(running) < max_workers:
+                model = waiting.pop(0)
+                reader, writer = context.Pipe(duplex=False)
+                process = context.Process(target=_run_model, args=(writer, self, model), daemon=True)
+                process.start()
+                writer.close()
+                running[reader] = (model, process)
+            remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            ready = wait(list(running), timeout=remaining)
+            if not ready:
+                break
+            for reader in ready:
+                model, process = running.pop(reader)
+                try:
+                    results[model] = reader.recv()
+                except EOFError:
+                    results[model] = ("error", f"the model process exited with code {process.exitcode}")
+                reader.close()
+                process.join()
+
+        # Whatever is left when the deadline passes timed out, stop its processes
+        for reader, (model, process) in running.items():
+            process.terminate()
+            process.join()
+            reader.close()
+            results[model] = ("timeout", None)
+
+        portfolios = []
+        for model in MODELS:
+            status, value = results.get(model, ("timeout", None))
+            if status == "ok":
+                # Metrics recorded in the model process stay there, record the result here
+                portfolios.append(_record(model, value))
+            elif status == "timeout":
+                metrics.incr(f"optimize.{model}.timeouts")
+                print(f"Error optimizing the {model} portfolio, reason - timed out after {self.timeout}s")
+            else:
+                metrics.incr(f"optimize.{model}.errors")
+                print(f"Error optimizing the {model} portfolio, reason - {value}")
+        return portfolios
+
     @staticmethod
     def load(model):
         model_name = model.lower()
@@ -66,9 +320,8 @@ class PortfolioOptimizer:
 
 
     def optimize_mean_variance(self) -> OptimizedPortfolio:
-        mu = expected_returns.mean_historical_return(self.stock_data)
-        returns = self.stock_data.pct_change().dropna(how="all")
-        cov_matrix = CovarianceShrinkage(self.stock_data).ledoit_wolf()
+        mu = self.market_stats.mean_historical_return
+        cov_matrix = self.market_stats.shrunk_cov
 
         ef = EfficientFrontier(mu, cov_matrix)
 
@@ -80,34 +333,24 @@ class PortfolioOptimizer:
         mu, sigma, sharpe_ratio = ef.portfolio_performance(verbose=True)
 
         # Create OptimizedPortfolio object
-        op = OptimizedPortfolio(portfolio_name, weights, mu, sigma, sharpe_ratio)
+        op = OptimizedPortfolio(portfolio_name, weights, mu, sigma, sharpe_ratio, solver_status=ef._opt.status)
         return op
 
 
     def optimize_black_litterman(self) -> OptimizedPortfolio:
         # Calculate expected returns and covariance matrix
-        cov_matrix = CovarianceShrinkage(self.stock_data).ledoit_wolf()
-        market_prior = expected_returns.capm_return(self.stock_data)
-
-        # TODO: Sentiment scores or user's views?
-        viewdict = {}
-        influence_coef = 100.0
-        if self.news_sentiment_scores is not None:
-            # Use sentiment scores to create absolute views
-            for ticker in self.stock_data.columns:
-                if ticker in self.news_sentiment_scores:
-                    viewdict[ticker] += self.news_sentiment_scores[ticker] / influence_coef
-        # Example views on stocks
-        viewdict = {
-            #"TSLA": 0.20,  # Stock 0 will return 50%
-            #"F": -0.05,  # Stock 3 will return -5%
-            #"KO": -0.05,  # Stock 2 will return -5%
-            #"MSFT": 0.50, # Stock 1 will return 50%
-            #"GILD": 0.10 # Stock 4 will return 10%
-        }
+        cov_matrix = self.market_stats.shrunk_cov
+        market_prior = self.market_stats.capm_return
+
+        # Views from the news sentiment, one per ticker with a score
+        views = sentiment_views(self.news_sentiment_scores, market_prior, cov_matrix) if self.news_sentiment_scores is not None else None
 
         risk_aversion = int(1 / self.risk_tolerance)  # Risk aversion parameter
-        bl = BlackLittermanModel(cov_matrix, pi=market_prior, absolute_views=viewdict, risk_aversion=risk_aversion)
+        if views is not None:
+            Q, P, omega = views
+            bl = BlackLittermanModel(cov_matrix, pi=market_prior, Q=Q, P=P, omega=omega, risk_aversion=risk_aversion)
+        else:
+            bl = BlackLittermanModel(cov_matrix, pi=market_prior, absolute_views={}, risk_aversion=risk_aversion)
 
         # Calculate posterior returns and covariance matrix
         posterior_returns = bl.bl_returns()
@@ -130,16 +373,17 @@ class PortfolioOptimizer:
         mu, sigma, sharpe_ratio = ef.portfolio_performance(verbose=True)
 
         # Create OptimizedPortfolio object
-        op = OptimizedPortfolio(portfolio_name, weights, mu, sigma, sharpe_ratio)
+        op = OptimizedPortfolio(portfolio_name, weights, mu, sigma, sharpe_ratio, solver_status=ef._opt.status)
         return op
 
 
     def optimize_hrp(self) -> OptimizedPortfolio:
-        # Normalize the stock data
-        returns = self.stock_data.pct_change()
+        # Cluster the cached sample covariance, the returns give the expected returns
+        returns = self.market_stats.returns
+        cov_matrix = self.market_stats.sample_cov
 
         # Optimize portfolio using HRP
-        hrp = HRPOpt(returns)
+        hrp = HierarchicalRiskParity(cov_matrix, returns, frequency=self.market_stats.frequency)
         hrp.optimize()
 
         # Calculate optimized weights and portfolio performance
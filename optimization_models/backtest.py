@@ -0,0 +1,112 @@
+import contextlib
+import io
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from .market_statistics import StreamingMarketStatistics
+from .PortfolioOptimizer import PortfolioOptimizer
+
+class BacktestResult:
+    """
+    Out-of-sample performance of each model, stored as arrays.
+    Arrays are indexed [model, ...] in the order of models.
+    """
+    def __init__(self, models, tickers, dates, rebalance_dates, weights, returns, turnover):
+        self.models = models
+        self.tickers = tickers
+        self.dates = dates
+        self.rebalance_dates = rebalance_dates
+        # (models, rebalances, tickers) target weights set at every rebalance
+        self.weights = weights
+        # (models, days) daily portfolio returns
+        self.returns = returns
+        # (models, rebalances) sum of absolute weight changes at every rebalance
+        self.turnover = turnover
+        self.equity = np.cumprod(1 + returns, axis=1)
+        self.drawdown = self.equity / np.maximum.accumulate(self.equity, axis=1) - 1
+
+    @property
+    def max_drawdown(self):
+        return self.drawdown.min(axis=1)
+
+    def equity_frame(self):
+        return pd.DataFrame(self.equity.T, index=self.dates, columns=self.models)
+
+def _optimize_window(market_stats, models, risk_tolerance):
+    tickers = market_stats.returns.columns
+    optimizer = PortfolioOptimizer(None, risk_tolerance, max_workers=1, market_stats=market_stats)
+
+    weights = np.full((len(models), len(tickers)), np.nan)
+    for i, model in enumerate(models):
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                portfolio = optimizer.optimize(model)
+        except Exception:
+            continue
+        weights[i] = 0.0
+        positions = tickers.get_indexer(portfolio.tickers)
+        known = positions >= 0
+        weights[i, positions[known]] = portfolio.weights[known]
+    return weights
+
+def backtest(stock_data, models=("mean-variance", "black-litterman", "hrp"), lookback=252, rebalance_every=21,
+             risk_tolerance=1.0, max_workers=None, frequency=252):
+    """
+    Walk-forward backtest of the PortfolioOptimizer models.
+    Every rebalance_every days each model is fitted on the previous lookback days of returns
+    and its weights are held, drifting with prices, until the next rebalance.
+    Windows are optimized concurrently on a process pool.
+    :param stock_data: DataFrame of prices without missing values, one column per ticker
+    :param models: names of the models to backtest, as accepted by PortfolioOptimizer.optimize
+    :param lookback: number of daily returns each model is fitted on
+    :param rebalance_every: number of days between rebalances
+    :param max_workers: number of worker processes, 1 optimizes the windows in this process
+    :return: BacktestResult
+    """
+    models = list(models)
+    returns = stock_data.pct_change().iloc[1:]
+    values = returns.to_numpy(dtype=np.float64)
+    n_days, n_assets = values.shape
+    if n_days <= lookback:
+        raise ValueError(f"Need more than {lookback} days of returns, got {n_days}")
+    rebalances = np.arange(lookback, n_days, rebalance_every)
+
+    # Slide the window forward, streaming the days entering it into the statistics, which evict
+    # the days leaving it
+    stream = StreamingMarketStatistics(returns.columns, frequency, window=lookback)
+    jobs = []
+    previous = 0
+    for end in rebalances:
+        stream.add_returns(values[previous:end], returns.index[previous:end])
+        previous = end
+        jobs.append((stream.to_market_statistics(), models, risk_tolerance))
+
+    if max_workers == 1:
+        window_weights = [_optimize_window(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            window_weights = list(executor.map(_optimize_window, *zip(*jobs)))
+    weights = np.stack(window_weights, axis=1)
+
+    # Models that failed in a window keep their previous weights, or start equally weighted
+    for m in range(len(models)):
+        for k in range(len(rebalances)):
+            if np.isnan(weights[m, k]).any():
+                weights[m, k] = weights[m, k - 1] if k > 0 else np.full(n_assets, 1 / n_assets)
+
+    # Hold each rebalance's weights until the next one, letting them drift with the asset returns
+    boundaries = np.append(rebalances, n_days)
+    portfolio_returns = np.zeros((len(models), n_days - lookback))
+    turnover = np.zeros((len(models), len(rebalances)))
+    drifted = np.zeros((len(models), n_assets))
+    for k, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        growth = np.cumprod(1 + values[start:end], axis=0)
+        period_weights = weights[:, k]
+        turnover[:, k] = np.abs(period_weights - drifted).sum(axis=1)
+        value = growth @ period_weights.T
+        previous_value = np.vstack([np.ones(len(models)), value[:-1]])
+        portfolio_returns[:, start - lookback:end - lookback] = (value / previous_value - 1).T
+        drifted = (period_weights * growth[-1]) / value[-1][:, None]
+
+    return BacktestResult(models, list(returns.columns), returns.index[lookback:].to_numpy(),
+                          returns.index[rebalances].to_numpy(), weights, portfolio_returns, turnover)
@@ -0,0 +1,110 @@
+import time
+import numpy as np
+import cvxpy as cp
+
+class FrontierSweep:
+    """
+    Portfolios along the efficient frontier, stored as arrays.
+    Row i of every array belongs to the i-th target, weights has one column per ticker.
+    """
+    def __init__(self, tickers, targets, weights, expected_returns, volatility, status, elapsed, risk_free_rate=0.0):
+        self.tickers = tickers
+        self.targets = targets
+        self.weights = weights
+        self.expected_returns = expected_returns
+        self.volatility = volatility
+        self.status = status
+        self.elapsed = elapsed
+        self.sharpe_ratio = (expected_returns - risk_free_rate) / volatility
+
+    def __len__(self):
+        return len(self.targets)
+
+    @property
+    def solved(self):
+        """Mask of the targets whose problem was solved to optimality."""
+        return np.isin(self.status, ("optimal", "optimal_inaccurate"))
+
+    def to_portfolio_set(self):
+        """The frontier portfolios as a PortfolioSet sharing these arrays, unsolved targets have NaN weights."""
+        from .PortfolioOptimizer import PortfolioSet
+        return PortfolioSet(self.tickers, self.weights, self.expected_returns, self.volatility, self.sharpe_ratio,
+                            name_prefix="Frontier")
+
+class EfficientFrontierEngine:
+    """
+    Mean-variance problems built once and re-solved for many targets.
+    The target return (minimum variance problem) and the target variance (maximum return
+    problem) are cvxpy parameters, so every new target only updates a parameter value and
+    warm starts from the previous solution.
+    :param expected_returns: Series of annualised expected returns
+    :param cov_matrix: DataFrame of the annualised covariance matrix
+    :param weight_bounds: (lower, upper) bound of every weight
+    :param solver: cvxpy solver name, None lets cvxpy choose
+    """
+    def __init__(self, expected_returns, cov_matrix, weight_bounds=(0, 1), solver=None):
+        self.tickers = list(expected_returns.index)
+        self.mu = np.asarray(expected_returns, dtype=np.float64)
+        self.cov = np.asarray(cov_matrix, dtype=np.float64)
+        self.solver = solver
+
+        self._w = cp.Variable(len(self.mu))
+        lower, upper = weight_bounds
+        constraints = [cp.sum(self._w) == 1, self._w >= lower, self._w <= upper]
+        portfolio_return = self.mu @ self._w
+        portfolio_variance = cp.quad_form(self._w, cp.psd_wrap(self.cov))
+
+        self._target_return = cp.Parameter(name="target_return")
+        self._min_variance = cp.Problem(cp.Minimize(portfolio_variance),
+                                        constraints + [portfolio_return >= self._target_return])
+        self._target_variance = cp.Parameter(name="target_variance", nonneg=True)
+        self._max_return = cp.Problem(cp.Maximize(portfolio_return),
+                                      constraints + [portfolio_variance <= self._target_variance])
+        self._max_return_bound = cp.Problem(cp.Maximize(portfolio_return), constraints)
+
+    @classmethod
+    def from_market_statistics(cls, market_stats, **kwargs):
+        """Builds the engine on the same inputs as the mean-variance model."""
+        return cls(market_stats.mean_historical_return, market_stats.shrunk_cov, **kwargs)
+
+    def _sweep(self, problem, parameter, targets):
+        start = time.perf_counter()
+        targets = np.asarray(targets, dtype=np.float64)
+        weights = np.full((len(targets), len(self.mu)), np.nan)
+        status = np.empty(len(targets), dtype=object)
+        for i, target in enumerate(targets):
+            parameter.value = float(target)
+            try:
+                problem.solve(solver=self.solver, warm_start=True)
+                status[i] = problem.status
+            except cp.SolverError as e:
+                status[i] = f"solver_error: {e}"
+                continue
+            if self._w.value is not None and problem.status in ("optimal", "optimal_inaccurate"):
+                weights[i] = self._w.value
+        portfolio_returns = weights @ self.mu
+        volatility = np.sqrt(np.einsum("ij,jk,ik->i", weights, self.cov, weights))
+        return FrontierSweep(self.tickers, targets, weights, portfolio_returns, volatility, status, time.perf_counter() - start)
+
+    def solve_returns(self, target_returns):
+        """Minimum variance portfolios for each target return."""
+        return self._sweep(self._min_variance, self._target_return, target_returns)
+
+    def solve_volatilities(self, target_volatilities):
+        """Maximum return portfolios for each target volatility."""
+        return self._sweep(self._max_return, self._target_variance, np.square(target_volatilities))
+
+    def return_range(self):
+        """Returns of the minimum volatility portfolio and of the maximum return portfolio."""
+        min_volatility = self.solve_returns([self.mu.min()])
+        self._max_return_bound.solve(solver=self.solver)
+        return float(min_volatility.expected_returns[0]), float(self._max_return_bound.value)
+
+    def sweep(self, n_points=100):
+        """
+        Traces the efficient frontier with n_points target returns, evenly spaced between the
+        minimum volatility portfolio and the maximum return portfolio.
+        :return: FrontierSweep
+        """
+        min_return, max_return = self.return_range()
+        return self.solve_returns(np.linspace(min_return, max_return, n_points))
@@ -0,0 +1,108 @@
+import collections
+import inspect
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy as sch
+import scipy.spatial.distance as ssd
+from pypfopt import HRPOpt, base_optimizer
+
+# Risk-free rate pypfopt's HRPOpt.portfolio_performance uses by default, so the reported Sharpe ratios match
+HRP_RISK_FREE_RATE = inspect.signature(HRPOpt.portfolio_performance).parameters["risk_free_rate"].default
+
+def cov_to_distance(cov):
+    """
+    Correlation distance sqrt((1 - corr) / 2) of a covariance matrix, in condensed form.
+    """
+    std = np.sqrt(np.diag(cov))
+    corr = cov / np.outer(std, std)
+    matrix = np.sqrt(np.clip((1.0 - corr) / 2.0, a_min=0.0, a_max=1.0))
+    return ssd.squareform(matrix, checks=False)
+
+def hrp_allocation(cov, order):
+    """
+    Hierarchical risk parity weights by iterative bisection of the quasi-diagonal order.
+    Every level of the bisection is processed at once: the clusters are (start, end) ranges of
+    the order, and their inverse-variance portfolio variances come from 2D prefix sums of the
+    reordered covariance scaled by the inverse variances, so each cluster costs O(1).
+    :param cov: (n, n) covariance matrix
+    :param order: quasi-diagonal order of the assets, e.g. the leaves of the linkage tree
+    :return: (n,) weights, in the original asset order
+    """
+    n_assets = len(order)
+    ordered = cov[np.ix_(order, order)]
+    inverse_variance = 1.0 / np.diag(ordered)
+
+    # Variance of a cluster's inverse-variance portfolio: sum(C_ij / (v_i v_j)) / sum(1 / v_i)^2
+    scaled = ordered * np.outer(inverse_variance, inverse_variance)
+    block_sums = np.zeros((n_assets + 1, n_assets + 1))
+    block_sums[1:, 1:] = scaled.cumsum(axis=0).cumsum(axis=1)
+    inverse_variance_sums = np.concatenate([[0.0], np.cumsum(inverse_variance)])
+
+    def cluster_variance(start, end):
+        quadratic = block_sums[end, end] - block_sums[start, end] - block_sums[end, start] + block_sums[start, start]
+        return quadratic / (inverse_variance_sums[end] - inverse_variance_sums[start]) ** 2
+
+    weights = np.ones(n_assets)
+    starts, ends = np.array([0]), np.array([n_assets])
+    while len(starts):
+        # Split every cluster with more than one asset in two halves, like HRPOpt
+        splittable = ends - starts > 1
+        starts, ends = starts[splittable], ends[splittable]
+        if not len(starts):
+            break
+        middles = starts + (ends - starts) // 2
+        first_variance = cluster_variance(starts, middles)
+        second_variance = cluster_variance(middles, ends)
+        alpha = 1 - first_variance / (first_variance + second_variance)
+
+        # Scale the first half of every cluster by alpha and the second half by 1 - alpha
+        child_starts = np.column_stack([starts, middles]).ravel()
+        child_ends = np.column_stack([middles, ends]).ravel()
+        factors = np.column_stack([alpha, 1 - alpha]).ravel()
+        lengths = child_ends - child_starts
+        positions = np.repeat(child_starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        weights[positions] *= np.repeat(factors, lengths)
+        starts, ends = child_starts, child_ends
+
+    allocation = np.empty(n_assets)
+    allocation[order] = weights
+    return allocation
+
+class HierarchicalRiskParity(base_optimizer.BaseOptimizer):
+    """
+    Array-based hierarchical risk parity, a drop-in replacement for pypfopt's HRPOpt.
+    It clusters a covariance matrix instead of raw returns, so the covariance cached for the
+    other models can be reused, and allocates without walking Python lists.
+    :param cov_matrix: DataFrame of the covariance of asset returns
+    :param returns: optional DataFrame of daily returns, used for the expected returns in portfolio_performance
+    :param frequency: number of periods in a year
+    """
+    def __init__(self, cov_matrix, returns=None, frequency=252):
+        self.cov_matrix = cov_matrix
+        self.returns = returns
+        self.frequency = frequency
+        self.clusters = None
+        super().__init__(len(cov_matrix.columns), list(cov_matrix.columns))
+
+    def optimize(self, linkage_method="single"):
+        """
+        Computes the HRP weights.
+        :param linkage_method: scipy linkage method
+        :return: OrderedDict of weights sorted by ticker, like HRPOpt
+        """
+        if linkage_method not in sch._LINKAGE_METHODS:
+            raise ValueError("linkage_method must be one recognised by scipy")
+        cov = self.cov_matrix.to_numpy(dtype=np.float64)
+        self.clusters = sch.linkage(cov_to_distance(cov), linkage_method)
+        allocation = hrp_allocation(cov, sch.leaves_list(self.clusters))
+        weights = collections.OrderedDict(pd.Series(allocation, index=self.tickers).sort_index())
+        self.set_weights(weights)
+        return weights
+
+    def portfolio_performance(self, verbose=False, risk_free_rate=HRP_RISK_FREE_RATE):
+        """
+        Expected return, volatility and Sharpe ratio of the portfolio, as computed by HRPOpt.
+        The covariance is expected to be annualised already.
+        """
+        mu = self.returns.mean() * self.frequency if self.returns is not None else None
+        return base_optimizer.portfolio_performance(self.weights, mu, self.cov_matrix, verbose, risk_free_rate)
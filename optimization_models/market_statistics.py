@@ -0,0 +1,288 @@
+import hashlib
+import inspect
+import threading
+from collections import deque
+from functools import wraps
+import numpy as np
+import pandas as pd
+from pypfopt import expected_returns, risk_models, CovarianceShrinkage
+from utils.cache import LRUCache
+
+# Number of distinct price frames whose statistics are kept in memory
+MARKET_STATISTICS_CACHE_SIZE = 16
+
+_market_statistics_cache = LRUCache(maxsize=MARKET_STATISTICS_CACHE_SIZE)
+
+# Risk-free rate pypfopt's capm_return uses by default, so streamed CAPM returns match it
+CAPM_RISK_FREE_RATE = inspect.signature(expected_returns.capm_return).parameters["risk_free_rate"].default
+
+def frame_hash(stock_data):
+    """
+    Content hash of a price frame, covering the index, the columns and the values.
+    :param stock_data: DataFrame of prices, one column per ticker
+    :return: hex digest identifying the frame contents
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(pd.util.hash_pandas_object(stock_data, index=True).values.tobytes())
+    digest.update("\x1f".join(map(str, stock_data.columns)).encode())
+    return digest.hexdigest()
+
+def _statistic(compute):
+    """Memoizes a MarketStatistics property so that it is computed at most once, even across threads."""
+    name = compute.__name__
+
+    @property
+    @wraps(compute)
+    def statistic(self):
+        values = self._values
+        if name not in values:
+            with self._lock:
+                if name not in values:
+                    values[name] = compute(self)
+        return values[name]
+    return statistic
+
+class MarketStatistics:
+    """
+    Lazily computed statistics of a price frame, shared by every optimization model.
+    Each statistic is computed on first access and then reused.
+    """
+    def __init__(self, stock_data, frequency=252):
+        self.stock_data = stock_data
+        self.frequency = frequency
+        self._values = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_returns(cls, returns, frequency=252, **values):
+        """
+        Builds statistics from returns instead of prices.
+        Statistics passed as keyword arguments (e.g. sample_cov) are used as they are
+        instead of being computed from the returns.
+        """
+        market_stats = cls(None, frequency)
+        market_stats._values.update(values, returns=returns)
+        return market_stats
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @_statistic
+    def returns(self):
+        return expected_returns.returns_from_prices(self.stock_data)
+
+    @_statistic
+    def sample_cov(self):
+        return risk_models.sample_cov(self.returns, returns_data=True, frequency=self.frequency)
+
+    @_statistic
+    def shrunk_cov(self):
+        shrinkage = CovarianceShrinkage(self.returns, returns_data=True, frequency=self.frequency)
+        shrunk_cov = shrinkage.ledoit_wolf()
+        if self.returns.isna().values.any():
+            # Tickers with different start dates: shrink the pairwise-complete covariance with the
+            # estimated intensity, rather than keep the covariance of the zero-filled returns
+            sample_cov = self.sample_cov.to_numpy()
+            target = np.trace(sample_cov) / len(sample_cov) * np.eye(len(sample_cov))
+            shrunk = (1 - shrinkage.delta) * sample_cov + shrinkage.delta * target
+            shrunk_cov = risk_models.fix_nonpositive_semidefinite(
+                pd.DataFrame(shrunk, index=shrunk_cov.index, columns=shrunk_cov.columns))
+        return shrunk_cov
+
+    @_statistic
+    def mean_historical_return(self):
+        return expected_returns.mean_historical_return(self.returns, returns_data=True, frequency=self.frequency)
+
+    @_statistic
+    def capm_return(self):
+        return expected_returns.capm_return(self.returns, returns_data=True, frequency=self.frequency)
+
+def get_market_statistics(stock_data, frequency=252):
+    """
+    Returns the shared MarketStatistics for a price frame, creating it on the first request.
+    :param stock_data: DataFrame of prices, one column per ticker
+    :param frequency: number of periods in a year
+    :return: MarketStatistics keyed by the content hash of the frame
+    """
+    key = (frame_hash(stock_data), frequency)
+    return _market_statistics_cache.get_or_create(key, lambda: MarketStatistics(stock_data, frequency))
+
+def clear_market_statistics_cache():
+    _market_statistics_cache.clear()
+
+class StreamingMarketStatistics:
+    """
+    Market statistics maintained incrementally as daily returns arrive.
+    Means and co-moments are merged batch by batch (Welford/Chan updates), together with
+    the sums Ledoit-Wolf shrinkage needs, so a new day costs O(n^2) whatever the history length.
+    With a window, the oldest days are evicted once more than window days were added.
+    :param tickers: tickers of the return columns
+    :param frequency: number of periods in a year
+    :param window: number of most recent days the statistics cover, None keeps every day
+    """
+    def __init__(self, tickers, frequency=252, window=None):
+        self.tickers = pd.Index(tickers)
+        self.frequency = frequency
+        self.window = window
+        n_assets = len(self.tickers)
+        self.count = 0
+        self.mean = np.zeros(n_assets)
+        # Sum of the outer products of the deviations from the mean
+        self.comoment = np.zeros((n_assets, n_assets))
+        self.log_sum = np.zeros(n_assets)
+        self.market_log_sum = 0.0
+        # Sums over days of |r|^2, |r|^4 and |r|^2 * r, for the Ledoit-Wolf shrinkage intensity
+        self.norm2_sum = 0.0
+        self.norm4_sum = 0.0
+        self.norm2_weighted_sum = np.zeros(n_assets)
+        self.last_prices = None
+        self._days = deque()
+        self._dates = deque()
+
+    @classmethod
+    def from_prices(cls, stock_data, frequency=252, window=None):
+        """
+        Seeds the statistics from a price frame, e.g. the output of preprocess_data.
+        """
+        stream = cls(stock_data.columns, frequency, window)
+        stream.update(stock_data)
+        return stream
+
+    def update(self, prices):
+        """
+        Appends new prices, a Series for one day or a DataFrame of several days.
+        """
+        if isinstance(prices, pd.Series):
+            prices = prices.to_frame().T
+        prices = prices.reindex(columns=self.tickers)
+        values = prices.to_numpy(dtype=np.float64)
+        if self.last_prices is not None:
+            values = np.vstack([self.last_prices, values])
+            dates = prices.index
+        else:
+            dates = prices.index[1:]
+        if len(values) > 1:
+            self.add_returns(values[1:] / values[:-1] - 1, dates)
+        self.last_prices = values[-1]
+
+    def add_returns(self, returns, dates=None):
+        returns = np.nan_to_num(np.atleast_2d(np.asarray(returns, dtype=np.float64)))
+        if len(returns) == 0:
+            return
+        self._merge(returns, sign=1)
+        if self.window is not None:
+            self._days.extend(returns)
+            self._dates.extend(dates if dates is not None else [None] * len(returns))
+            # Evict the days that fell out of the window
+            n_evicted = len(self._days) - self.window
+            if n_evicted > 0:
+                evicted = np.array([self._days.popleft() for _ in range(n_evicted)])
+                for _ in range(n_evicted):
+                    self._dates.popleft()
+                self._merge(evicted, sign=-1)
+
+    def _merge(self, returns, sign):
+        n_batch = len(returns)
+        batch_mean = returns.mean(axis=0)
+        deviations = returns - batch_mean
+        batch_comoment = deviations.T @ deviations
+        norm2 = np.einsum("ij,ij->i", returns, returns)
+
+        if sign > 0:
+            total = self.count + n_batch
+            delta = batch_mean - self.mean
+            self.comoment += batch_comoment + np.outer(delta, delta) * (self.count * n_batch / total)
+            self.mean = self.mean + delta * (n_batch / total)
+        else:
+            total = self.count - n_batch
+            remaining_mean = (self.count * self.mean - n_batch * batch_mean) / total if total else np.zeros_like(self.mean)
+            delta = batch_mean - remaining_mean
+            self.comoment -= batch_comoment + np.outer(delta, delta) * (total * n_batch / self.count)
+            self.mean = remaining_mean
+        self.count = total
+
+        self.log_sum += sign * np.log1p(returns).sum(axis=0)
+        self.market_log_sum += sign * np.log1p(returns.mean(axis=1)).sum()
+        self.norm2_sum += sign * norm2.sum()
+        self.norm4_sum += sign * (norm2 ** 2).sum()
+        self.norm2_weighted_sum += sign * (norm2 @ returns)
+
+    @property
+    def returns(self):
+        """Returns of the days in the window, None when no window is kept."""
+        if self.window is None:
+            return None
+        return pd.DataFrame(np.array(self._days).reshape(-1, len(self.tickers)), index=list(self._dates), columns=self.tickers)
+
+    @property
+    def sample_cov(self):
+        cov = self.comoment / (self.count - 1) * self.frequency
+        return pd.DataFrame(cov, index=self.tickers, columns=self.tickers)
+
+    @property
+    def mean_historical_return(self):
+        # Geometric mean (CAGR), like pypfopt's mean_historical_return
+        return pd.Series(np.expm1(self.log_sum * self.frequency / self.count), index=self.tickers)
+
+    @property
+    def capm_return(self):
+        # Equally weighted market proxy, like pypfopt's capm_return without market prices
+        cov = self.comoment
+        betas = cov.mean(axis=1) / cov.mean()
+        market_return = np.expm1(self.market_log_sum * self.frequency / self.count)
+        risk_free_rate = CAPM_RISK_FREE_RATE
+        return pd.Series(risk_free_rate + betas * (market_return - risk_free_rate), index=self.tickers)
+
+    def ledoit_wolf_shrinkage(self):
+        """
+        Shrinkage intensity of sklearn's ledoit_wolf, computed from the running sums.
+        """
+        n_samples, n_features = self.count, len(self.tickers)
+        if n_features == 1:
+            return 0.0
+        mean = self.mean
+        mean_norm2 = mean @ mean
+        raw_second_moment = self.comoment + n_samples * np.outer(mean, mean)
+        # Sum over days of |r - mean|^4, expanded so it only needs the running sums
+        beta_ = (self.norm4_sum
+                 - 4 * mean @ self.norm2_weighted_sum
+                 + 4 * mean @ raw_second_moment @ mean
+                 + 2 * mean_norm2 * self.norm2_sum
+                 - 4 * mean_norm2 * n_samples * mean_norm2
+                 + n_samples * mean_norm2 ** 2)
+        emp_cov_trace = np.diag(self.comoment) / n_samples
+        mu = emp_cov_trace.sum() / n_features
+        delta_ = np.sum(self.comoment ** 2) / n_samples ** 2
+        beta = 1.0 / (n_features * n_samples) * (beta_ / n_samples - delta_)
+        delta = (delta_ - 2.0 * mu * emp_cov_trace.sum() + n_features * mu ** 2) / n_features
+        beta = min(beta, delta)
+        return 0.0 if beta == 0 else beta / delta
+
+    @property
+    def shrunk_cov(self):
+        """Ledoit-Wolf shrunk covariance, matching CovarianceShrinkage(...).ledoit_wolf()."""
+        n_features = len(self.tickers)
+        emp_cov = self.comoment / self.count
+        shrinkage = self.ledoit_wolf_shrinkage()
+        mu = np.trace(emp_cov) / n_features
+        shrunk = (1 - shrinkage) * emp_cov
+        shrunk.flat[::n_features + 1] += shrinkage * mu
+        return pd.DataFrame(shrunk * self.frequency, index=self.tickers, columns=self.tickers)
+
+    def to_market_statistics(self):
+        """
+        MarketStatistics seeded with the streamed values, ready to be passed to PortfolioOptimizer.
+        """
+        return MarketStatistics.from_returns(
+            self.returns, self.frequency,
+            sample_cov=self.sample_cov,
+            shrunk_cov=self.shrunk_cov,
+            mean_historical_return=self.mean_historical_return,
+            capm_return=self.capm_return,
+        )
@@ -1,9 +1,14 @@
+import time
+import numpy as np
+import pandas as pd
 from pypfopt import expected_returns
 from pypfopt import EfficientFrontier
 from pypfopt import risk_models
+from .frontier import EfficientFrontierEngine
 
 def calculate_risk_tolerance(age, financial_state, risk_aversion):
     # We use a simple weighted average for the starting point
+    # (works element-wise when the inputs are NumPy arrays)
     age_factor = 1 - age / 100
     risk_tolerance = (age_factor * 0.5) + (financial_state * 0.3) + (risk_aversion * 0.2)
     return risk_tolerance
@@ -24,4 +29,70 @@ def optimize_portfolio_risk_tolerance(stock_data, risk_tolerance, target_return_
     # Minimize risk for the given target return
     ef.efficient_return(target_return)
 
-    return ef
\ No newline at end of file
+    return ef
+
+class RiskProfileResults:
+    """
+    Optimized portfolios of many investor profiles over the same universe, stored as arrays.
+    Row i of every array belongs to the i-th profile, weights has one column per ticker.
+    """
+    def __init__(self, tickers, risk_tolerance, target_returns, weights, expected_returns, volatility, sharpe_ratio, status, elapsed):
+        self.tickers = tickers
+        self.risk_tolerance = risk_tolerance
+        self.target_returns = target_returns
+        self.weights = weights
+        self.expected_returns = expected_returns
+        self.volatility = volatility
+        self.sharpe_ratio = sharpe_ratio
+        self.status = status
+        self.elapsed = elapsed
+
+    def __len__(self):
+        return len(self.risk_tolerance)
+
+    @property
+    def profiles_per_second(self):
+        return len(self) / self.elapsed if self.elapsed > 0 else float("inf")
+
+    def to_frame(self):
+        return pd.DataFrame(self.weights, columns=self.tickers)
+
+    def to_portfolio_set(self):
+        """The profile portfolios as a PortfolioSet sharing these arrays."""
+        from .PortfolioOptimizer import PortfolioSet
+        return PortfolioSet(self.tickers, self.weights, self.expected_returns, self.volatility, self.sharpe_ratio,
+                            name_prefix="Profile")
+
+def optimize_portfolios_risk_tolerance(stock_data, profiles, target_return_factor=0.75, risk_free_rate=0.0):
+    """
+    Batch version of optimize_portfolio_risk_tolerance for many investor profiles.
+    Expected returns and covariance are computed once, and one minimum variance problem
+    is re-solved for every distinct target return by updating its target_return parameter.
+    :param stock_data: DataFrame of prices, one column per ticker
+    :param profiles: sequence of (age, financial_state, risk_aversion) tuples
+    :param target_return_factor: share of the return range a fully risk tolerant investor targets
+    :param risk_free_rate: risk-free rate used for the Sharpe ratios
+    :return: RiskProfileResults
+    """
+    start = time.perf_counter()
+    profiles = np.asarray(profiles, dtype=np.float64).reshape(-1, 3)
+    risk_tolerance = calculate_risk_tolerance(profiles[:, 0], profiles[:, 1], profiles[:, 2])
+
+    # Shared inputs, computed once for the whole batch
+    mu = expected_returns.mean_historical_return(stock_data)
+    cov_matrix = risk_models.sample_cov(stock_data)
+
+    min_return = mu.min()
+    max_return = mu.max()
+    target_returns = min_return + (max_return - min_return) * risk_tolerance * target_return_factor
+
+    # Profiles with the same target share a solve, all targets re-solve one parameterized problem
+    unique_targets, profile_index = np.unique(target_returns, return_inverse=True)
+    frontier = EfficientFrontierEngine(mu, cov_matrix).solve_returns(unique_targets)
+
+    portfolio_returns = frontier.expected_returns[profile_index]
+    volatility = frontier.volatility[profile_index]
+    sharpe_ratio = (portfolio_returns - risk_free_rate) / volatility
+
+    return RiskProfileResults(frontier.tickers, risk_tolerance, target_returns, frontier.weights[profile_index], portfolio_returns,
+                              volatility, sharpe_ratio, frontier.status[profile_index], time.perf_counter() - start)
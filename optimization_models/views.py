@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+# Annualised volatilities a fully positive (or negative) sentiment moves a view away from the prior
+SENTIMENT_VIEW_SCALE = 0.1
+# Smallest sentiment strength given a view, weaker scores would only add near-infinite uncertainties
+SENTIMENT_MIN_STRENGTH = 0.05
+
+def sentiment_views(sentiment_scores, prior, cov_matrix, scale=SENTIMENT_VIEW_SCALE, tau=0.05,
+                    min_strength=SENTIMENT_MIN_STRENGTH):
+    """
+    Absolute Black-Litterman views from signed news sentiment, built with array operations.
+    A ticker with sentiment s in [-1, 1] gets the view prior + scale * s * volatility and the
+    uncertainty tau * variance / |s|, so stronger sentiment pulls the posterior harder.
+    Tickers without sentiment, or with |s| below min_strength, get no view.
+    :param sentiment_scores: dict or Series of signed sentiment per ticker, e.g. get_sentiment_scores
+    :param prior: Series of prior expected returns
+    :param cov_matrix: DataFrame of the annualised covariance matrix
+    :return: (Q, P, omega) arrays for BlackLittermanModel, None when no ticker gets a view
+    """
+    tickers = cov_matrix.index
+    sentiment = pd.Series(sentiment_scores, dtype=np.float64).reindex(tickers).to_numpy()
+    has_view = np.abs(np.nan_to_num(sentiment)) >= min_strength
+    if not has_view.any():
+        return None
+
+    variance = np.diag(cov_matrix.to_numpy())[has_view]
+    strength = np.clip(sentiment[has_view], -1.0, 1.0)
+    Q = (prior.reindex(tickers).to_numpy()[has_view] + scale * strength * np.sqrt(variance)).reshape(-1, 1)
+    P = np.eye(len(tickers))[has_view]
+    omega = np.diag(tau * variance / np.abs(strength))
+    return Q, P, omega
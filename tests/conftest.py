@@ -0,0 +1,26 @@
+import importlib.util
+import sys
+import types
+import pytest
+
+# data/config.py holds the local credentials and is not committed, the tests only use the SQLite backend
+if importlib.util.find_spec("data.config") is None:
+    config = types.ModuleType("data.config")
+    config.DATABASE_CONFIG = {}
+    sys.modules["data.config"] = config
+
+from data import database
+
+@pytest.fixture
+def sqlite_database(tmp_path, monkeypatch):
+    """
+    Points the database module at an empty SQLite file.
+    :return: path of the database file
+    """
+    path = str(tmp_path / "portfolio.sqlite3")
+    monkeypatch.setattr(database, "DATABASE_BACKEND", "sqlite")
+    monkeypatch.setattr(database, "SQLITE_PATH", path)
+    monkeypatch.setattr(database, "_pool", None)
+    yield path
+    if database._pool is not None:
+        database._pool.close()
@@ -0,0 +1,84 @@
+import json
+import pickle
+import sqlite3
+import types
+import pandas as pd
+import pytest
+from data import database
+from data.migrate_legacy_schema import MigrationError, migrate
+
+def _legacy_database(path, tickers):
+    # Tables as the untyped layout created them, with Tickers rows of (TickerObject, Name)
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE Tickers (ID INTEGER PRIMARY KEY, TickerObject BLOB, Symbol TEXT, Name TEXT);
+        CREATE TABLE StockPrices (TickerID INTEGER, Date TEXT, AdjClose REAL, Volume REAL);
+        CREATE TABLE Articles (TickerID INTEGER, Title TEXT, Description TEXT, Sentiment REAL);
+        CREATE TABLE OptimizedPortfolios (ID INTEGER PRIMARY KEY, Name TEXT, CleanWeights TEXT,
+                                          ExpectedReturns REAL, Volatility REAL, SharpeRatio REAL);
+    """)
+    connection.executemany("INSERT INTO Tickers (TickerObject, Name) VALUES (?, ?)", tickers)
+    connection.commit()
+    return connection
+
+def test_migrate_legacy_schema(sqlite_database):
+    connection = _legacy_database(sqlite_database, [
+        (pickle.dumps(types.SimpleNamespace(ticker="MSFT")), None),
+        (pickle.dumps("AAPL"), None),
+        (b"not a pickle", "AAPL"),
+    ])
+    connection.executemany("INSERT INTO StockPrices VALUES (?, ?, ?, ?)", [
+        (1, "2021-01-04", 200.0, None), (2, "2021-01-04", 120.0, None), (3, "2021-01-04", 121.0, None), (3, "2021-01-05", 122.0, None),
+    ])
+    connection.execute("INSERT INTO OptimizedPortfolios (Name, CleanWeights, ExpectedReturns, Volatility, SharpeRatio) "
+                       "VALUES ('HRP', ?, 0.1, 0.2, 0.5)", (json.dumps({"AAPL": 0.6, "MSFT": 0.4}),))
+    connection.commit()
+
+    assert migrate(connection) == {"merged_tickers": 1, "migrated_portfolios": 1}
+    connection.commit()
+    assert migrate(connection) == {"merged_tickers": 0, "migrated_portfolios": 0}
+    connection.commit()
+    connection.close()
+
+    assert database.load_tickers() == ["AAPL", "MSFT"]
+    # The merged row's prices are kept where the oldest row has none
+    prices = database.load_price_matrix(["AAPL", "MSFT"])
+    assert prices["AAPL"].tolist() == [120.0, 122.0]
+    name, weights, *_ = database.load_optimized_portfolio("hrp")
+    assert dict(weights) == {"AAPL": 0.6, "MSFT": 0.4}
+
+def test_migrate_legacy_schema_keeps_unmapped_rows(sqlite_database):
+    connection = _legacy_database(sqlite_database, [(pickle.dumps("AAPL"), None), (b"not a pickle", None)])
+    with pytest.raises(MigrationError):
+        migrate(connection)
+    connection.rollback()
+
+    assert connection.execute("SELECT COUNT(*) FROM Tickers").fetchone()[0] == 2
+    assert "TickerObject" in database.table_columns(connection.cursor(), "Tickers")
+    connection.close()
+    # The pool refuses to work on a database still in the legacy layout
+    with pytest.raises(RuntimeError):
+        database.get_pool()
+
+def test_load_price_matrix_without_tickers(sqlite_database):
+    database.store_price_matrix(pd.DataFrame({"AAPL": [1.0, 2.0]}, index=pd.to_datetime(["2021-01-04", "2021-01-05"])))
+    assert database.load_price_matrix([]).empty
+    assert database.load_stock_prices([]).empty
+
+def _count(path, table):
+    connection = sqlite3.connect(path)
+    count = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    connection.close()
+    return count
+
+def test_store_articles_twice_is_a_no_op(sqlite_database):
+    articles = pd.DataFrame({
+        "ticker": ["AAPL", "NEWCO", None],
+        "title": ["Apple beats estimates", "NewCo lists", "Markets rally"],
+        "description": ["", "", ""],
+        "sentiment": [0.8, 0.1, 0.3],
+    })
+    assert database.store_articles(articles) == 2
+    assert database.store_articles(articles) == 2
+    assert _count(sqlite_database, "Articles") == 2
+    assert sorted(database.load_articles()["ticker"]) == ["AAPL", "NEWCO"]
@@ -0,0 +1,182 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded mapping that evicts the least recently used entry.
+    :param maxsize: maximum number of entries kept in the cache
+    :param ttl: seconds an entry stays valid, None keeps entries until they are evicted
+    """
+    def __init__(self, maxsize=32, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                expires_at, value = self._data[key]
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            # Evict the oldest entries once we are over capacity
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                value = factory()
+                self.put(key, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._data:
+                return False
+            expires_at = self._data[key][0]
+            return expires_at is None or expires_at > time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+class DiskCache:
+    """
+    Pickled key-value cache in a SQLite file, shared by every process that opens the same path.
+    Entries expire after ttl seconds, the least recently used ones are evicted above maxsize.
+    :param path: path of the SQLite database file
+    :param maxsize: maximum number of entries kept on disk
+    :param ttl: seconds an entry stays valid, None keeps entries until they are evicted
+    """
+    def __init__(self, path, maxsize=1024, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connect(self):
+        # Opened on first use and again in every process, a preloading master must not share it with its workers
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS Cache (
+                    Key TEXT PRIMARY KEY,
+                    Value BLOB NOT NULL,
+                    ExpiresAt REAL,
+                    LastUsed REAL NOT NULL
+                )
+            """)
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT Value, ExpiresAt FROM Cache WHERE Key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                return default
+            connection.execute("UPDATE Cache SET LastUsed = ? WHERE Key = ?", (now, key))
+            connection.commit()
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO Cache (Key, Value, ExpiresAt, LastUsed) VALUES (?, ?, ?, ?)",
+                               (key, payload, expires_at, now))
+            # Drop expired entries, then the least recently used ones above capacity
+            connection.execute("DELETE FROM Cache WHERE ExpiresAt IS NOT NULL AND ExpiresAt <= ?", (now,))
+            connection.execute("""
+                DELETE FROM Cache WHERE Key IN (
+                    SELECT Key FROM Cache ORDER BY LastUsed DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.maxsize,))
+            connection.commit()
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM Cache")
+            connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            connection = self._connect()
+            size = connection.execute("SELECT COUNT(*) FROM Cache").fetchone()[0]
+            return {"size": size, "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+class TieredCache:
+    """
+    In-process LRU cache in front of an optional DiskCache.
+    Disk hits are promoted to the in-process tier.
+    """
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return default if value is None else value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        return {"memory": self.memory.stats(), "disk": self.disk.stats() if self.disk is not None else None}
@@ -0,0 +1,213 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import metrics, log_event
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, key, id=None, status="queued", result=None, error=None, submitted_at=None, started_at=None,
+                 finished_at=None):
+        self.id = id or uuid.uuid4().hex
+        self.key = key
+        self.status = status
+        self.result = result
+        self.error = error
+        self.submitted_at = submitted_at or time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+class JobQueue:
+    """
+    Job queue running submitted work on a bounded pool of worker threads, with the job states
+    and results kept in a SQLite file.
+    Every process opening the same path sees the same jobs, so a job submitted to one gunicorn
+    worker can be polled from any other, and duplicate detection and max_pending apply across workers.
+    Submissions with the same key as a job still in flight share that job.
+    :param path: path of the SQLite database file
+    :param max_workers: number of jobs running at the same time in this process
+    :param max_pending: maximum number of queued and running jobs, further submissions raise QueueFull
+    :param keep_finished: number of finished jobs whose results are kept for polling
+    :param stale_after: seconds after which a running job is considered lost, e.g. it hangs.
+        Jobs of a worker process that died are lost right away, whatever their age
+    """
+    _COLUMNS = "ID, Key, Status, Result, Error, SubmittedAt, StartedAt, FinishedAt"
+
+    def __init__(self, path, max_workers=2, max_pending=16, keep_finished=256, stale_after=600):
+        self.path = path
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.stale_after = stale_after
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+        self._executor = None
+
+    def _connect(self):
+        # The connection and the threads are opened per process, a preloading master must not share them with its workers
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS Jobs (
+                    ID TEXT PRIMARY KEY,
+                    Key TEXT NOT NULL,
+                    Status TEXT NOT NULL,
+                    Result BLOB,
+                    Error TEXT,
+                    SubmittedAt REAL NOT NULL,
+                    StartedAt REAL,
+                    FinishedAt REAL,
+                    Owner INTEGER
+                )
+            """)
+            # Job stores created before the owning process was recorded
+            if "Owner" not in [row[1] for row in self._connection.execute("PRAGMA table_info(Jobs)")]:
+                self._connection.execute("ALTER TABLE Jobs ADD COLUMN Owner INTEGER")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS IX_Jobs_Status_Key ON Jobs (Status, Key)")
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        return self._connection
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) and returns its Job, or the in-flight Job with the same key.
+        """
+        with self._lock:
+            connection = self._connect()
+            # Lock the database for writing, so two workers cannot both queue the same key
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire_stale(connection)
+                row = connection.execute(f"SELECT {self._COLUMNS} FROM Jobs WHERE Key = ? AND Status IN ('queued', 'running')",
+                                         (key,)).fetchone()
+                if row is not None:
+                    connection.execute("COMMIT")
+                    return self._job(row)
+                in_flight = connection.execute("SELECT COUNT(*) FROM Jobs WHERE Status IN ('queued', 'running')").fetchone()[0]
+                if in_flight >= self.max_pending:
+                    raise QueueFull(f"{in_flight} jobs are already queued or running")
+                job = Job(key)
+                # The job runs on this process' threads, it is lost if this process dies
+                connection.execute("INSERT INTO Jobs (ID, Key, Status, SubmittedAt, Owner) VALUES (?, ?, ?, ?, ?)",
+                                   (job.id, job.key, job.status, job.submitted_at, os.getpid()))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        try:
+            job.status = "running"
+            job.started_at = time.time()
+            with self._lock:
+                self._connection.execute("UPDATE Jobs SET Status = ?, StartedAt = ? WHERE ID = ?", (job.status, job.started_at, job.id))
+            try:
+                job.result = fn(*args, **kwargs)
+                job.status = "done"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+            job.finished_at = time.time()
+            result = pickle.dumps(job.result, protocol=pickle.HIGHEST_PROTOCOL) if job.result is not None else None
+            self._finish(job, result)
+        except Exception as e:
+            # The job must not stay in flight when its result cannot be pickled or stored
+            metrics.incr("jobs.errors")
+            log_event("job_error", job_id=job.id, key=job.key, error=str(e))
+            job.result, job.error, job.status, job.finished_at = None, str(e), "failed", time.time()
+            try:
+                self._finish(job, None)
+            except Exception:
+                # Left to _expire_stale, the database cannot be written
+                pass
+
+    def _finish(self, job, result):
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("UPDATE Jobs SET Status = ?, Result = ?, Error = ?, FinishedAt = ? WHERE ID = ?",
+                                   (job.status, result, job.error, job.finished_at, job.id))
+                # Forget the oldest finished jobs
+                connection.execute("""
+                    DELETE FROM Jobs WHERE ID IN (
+                        SELECT ID FROM Jobs WHERE Status IN ('done', 'failed') ORDER BY FinishedAt DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.keep_finished,))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # The process exists but belongs to another user
+            return True
+        return True
+
+    def _expire_stale(self, connection):
+        # Jobs whose worker died or hangs never finish, fail them so they stop counting as in flight
+        owners = [owner for (owner,) in connection.execute(
+            "SELECT DISTINCT Owner FROM Jobs WHERE Status IN ('queued', 'running') AND Owner IS NOT NULL")]
+        dead = [owner for owner in owners if not self._is_alive(owner)]
+        # A queued job of a live worker only waits for a free thread, its age alone does not make it lost
+        lost = "(Status = 'running' OR Owner IS NULL) AND COALESCE(StartedAt, SubmittedAt) < ?"
+        if dead:
+            lost += f" OR Owner IN ({', '.join('?' * len(dead))})"
+        now = time.time()
+        connection.execute(f"""
+            UPDATE Jobs SET Status = 'failed', Error = 'The job was lost', FinishedAt = ?
+            WHERE Status IN ('queued', 'running') AND ({lost})
+        """, (now, now - self.stale_after, *dead))
+
+    @staticmethod
+    def _job(row):
+        job_id, key, status, result, error, submitted_at, started_at, finished_at = row
+        return Job(key, id=job_id, status=status, result=pickle.loads(result) if result is not None else None, error=error,
+                   submitted_at=submitted_at, started_at=started_at, finished_at=finished_at)
+
+    def get(self, job_id, with_result=True):
+        """
+        :param with_result: whether to load the result, status polls only need the job's state
+        """
+        columns = self._COLUMNS if with_result else self._COLUMNS.replace("Result", "NULL")
+        with self._lock:
+            row = self._connect().execute(f"SELECT {columns} FROM Jobs WHERE ID = ?", (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._connect().execute("SELECT Status, COUNT(*) FROM Jobs GROUP BY Status").fetchall())
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "finished": counts.get("done", 0) + counts.get("failed", 0),
+            "max_pending": self.max_pending,
+        }
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+logger = logging.getLogger("portfolio.metrics")
+
+# Identifier of the pipeline run the current stages belong to, included in their log records
+current_run = ContextVar("current_run", default=None)
+
+def log_event(event, **fields):
+    """
+    Writes one structured log record, a JSON object with the event name and its fields.
+    """
+    if logger.isEnabledFor(logging.INFO):
+        run_id = current_run.get()
+        if run_id is not None:
+            fields.setdefault("run_id", run_id)
+        logger.info(json.dumps({"event": event, **fields}, default=str))
+
+def memory_usage():
+    """
+    Resident and shared memory of this process in bytes, shared pages include the ones
+    inherited copy-on-write from a preloading parent.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            _, resident, shared = (int(value) for value in f.read().split()[:3])
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        return {"rss_bytes": resident * page_size, "shared_bytes": shared * page_size}
+    except (OSError, ValueError):
+        # No procfs, fall back to the peak resident size
+        return {"rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, "shared_bytes": None}
+
+class Metrics:
+    """
+    Process-wide counters and stage timers.
+    Every timed stage is also written to the structured log with the fields it recorded.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._timers = {}
+        self.last_profile = None
+        self.started_at = time.time()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self._timers.setdefault(name, {"count": 0, "seconds_total": 0.0, "seconds_max": 0.0, "seconds_last": 0.0})
+            timer["count"] += 1
+            timer["seconds_total"] += seconds
+            timer["seconds_max"] = max(timer["seconds_max"], seconds)
+            timer["seconds_last"] = seconds
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        """
+        Times a with-block as a pipeline stage.
+        The block receives the fields dict and can add what it measured, e.g. fields["rows"] = 100.
+        """
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield fields
+        except BaseException:
+            status = "error"
+            self.incr(f"{stage}.errors")
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(stage, seconds)
+            log_event("stage", stage=stage, seconds=round(seconds, 6), status=status, **fields)
+
+    def snapshot(self):
+        with self._lock:
+            timers = {name: dict(timer, seconds_mean=timer["seconds_total"] / timer["count"])
+                      for name, timer in self._timers.items()}
+            return {
+                "uptime_seconds": time.time() - self.started_at,
+                "counters": dict(self._counters),
+                "timers": timers,
+                "last_profile": self.last_profile,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+            self.last_profile = None
+
+metrics = Metrics()
+
+def timed(stage):
+    """Decorator timing every call of a function as a stage of the process-wide metrics."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    """
+    Statistical profiler sampling the stack of one thread at a fixed interval.
+    It reads sys._current_frames from a background thread, so the profiled code runs unmodified
+    and the overhead only depends on the interval.
+    :param thread_id: identifier of the thread to sample, defaults to the thread starting the profiler
+    :param interval: seconds between two samples
+    :param max_depth: number of innermost frames kept per sample
+    """
+    def __init__(self, thread_id=None, interval=0.005, max_depth=40):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.n_samples = 0
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started_at = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[tuple(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started_at
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def top(self, n=20):
+        """
+        The functions found in the most samples, counting every frame of the stack (inclusive time).
+        :return: list of {"function", "samples", "share"} dicts, most sampled first
+        """
+        inclusive = Counter()
+        for stack, count in self.samples.items():
+            for function in set(stack):
+                inclusive[function] += count
+        total = max(self.n_samples, 1)
+        return [{"function": function, "samples": count, "share": count / total}
+                for function, count in inclusive.most_common(n)]
+
+    def report(self, n=20):
+        return {"elapsed": self.elapsed, "interval": self.interval, "samples": self.n_samples, "top": self.top(n)}
@@ -1,158 +1,179 @@
-import plotly.graph_objs as go
-from sklearn.preprocessing import minmax_scale
-from plotly.express.colors import sample_colorscale
-from plotly.subplots import make_subplots
-
-def plot_portfolios(portfolios):
-    names = []
-    portfolio_returns = []
-    portfolio_volatilities = []
-    sharpe_ratios = []
-
+import hashlib
+import json
+import numpy as np
+from plotly.colors import sample_colorscale
+from .cache import LRUCache
+from .metrics import metrics
+
+# Number of rendered figures kept in memory, keyed by the hash of the portfolios they show
+FIGURE_CACHE_SIZE = 64
+
+_figure_cache = LRUCache(maxsize=FIGURE_CACHE_SIZE)
+
+def portfolio_set_hash(portfolios, frontier=None):
+    """
+    Hash of everything the chart shows: names, metrics and weights of the portfolios and the frontier curve.
+    """
+    digest = hashlib.blake2b(digest_size=16)
     for portfolio in portfolios:
-        name = portfolio.name.title()
-        portfolio_return, portfolio_volatility, sharpe_ratio = portfolio.expected_returns, portfolio.volatility, portfolio.sharpe_ratio
-
-        names.append(name)
-        portfolio_returns.append(portfolio_return)
-        portfolio_volatilities.append(portfolio_volatility)
-        sharpe_ratios.append(sharpe_ratio)
+        digest.update(json.dumps([portfolio.name, float(portfolio.expected_returns), float(portfolio.volatility),
+                                  float(portfolio.sharpe_ratio), [str(ticker) for ticker in portfolio.tickers]]).encode())
+        digest.update(np.ascontiguousarray(portfolio.weights, dtype=np.float64).tobytes())
+    if frontier is not None:
+        solved = frontier.solved
+        digest.update(np.ascontiguousarray(frontier.expected_returns[solved]).tobytes())
+        digest.update(np.ascontiguousarray(frontier.volatility[solved]).tobytes())
+    return digest.hexdigest()
+
+def plot_portfolios(portfolios, frontier=None):
+    """
+    Renders the portfolio comparison chart.
+    The figure is returned as compact JSON for Plotly.newPlot, and cached on the hash of the portfolio set.
+    :param portfolios: list of OptimizedPortfolio objects
+    :param frontier: optional FrontierSweep drawn as the efficient frontier curve
+    :return: JSON of the figure, {"data": [...], "layout": {...}}
+    """
+    with metrics.timer("plot_portfolios", portfolios=len(portfolios)) as stage:
+        key = portfolio_set_hash(portfolios, frontier)
+        graph_data = _figure_cache.get(key)
+        stage["cache_hit"] = graph_data is not None
+        if graph_data is None:
+            figure = portfolio_figure(portfolios, frontier)
+            # Escape "</" so the JSON can be inlined in a <script> tag
+            graph_data = json.dumps(figure, separators=(",", ":")).replace("</", "<\\/")
+            _figure_cache.put(key, graph_data)
+        stage["payload_bytes"] = len(graph_data)
+    return graph_data
 
-    # Create a subplot, you might add more plots in the future
-    fig = make_subplots(rows=2, cols=1, subplot_titles=('<b>Portfolio Performance</b>', '<b>Asset Weights</b>'))
+def portfolio_figure(portfolios, frontier=None):
+    """
+    Builds the portfolio comparison figure as plain dicts.
+    All portfolios share one scatter trace, each portfolio has one bar trace of asset weights
+    and the efficient frontier is one line trace.
+    """
+    names = [portfolio.name.title() for portfolio in portfolios]
+    portfolio_returns = [float(portfolio.expected_returns) for portfolio in portfolios]
+    portfolio_volatilities = [float(portfolio.volatility) for portfolio in portfolios]
+    sharpe_ratios = [float(portfolio.sharpe_ratio) for portfolio in portfolios]
 
     title = '<b>Portfolio Optimization Comparison</b>'
+    colorscale = 'Portland'
+    # Every model can fail, the chart then only shows the frontier and a message
+    min_sharpe = min(sharpe_ratios, default=0.0)
+    max_sharpe = max(sharpe_ratios, default=0.0)
+    spread = max_sharpe - min_sharpe
+    colors = sample_colorscale(colorscale, [(sr - min_sharpe) / spread if spread else 0.0 for sr in sharpe_ratios])
 
-    # Create a dropdown menu
-    dropdown_menu = []
-    annotations = []
-    dropdown_menu.append(dict(
-        label='All Portfolios',
-        method='update',
-        args=[{'visible': [True] * len(portfolios)},
-              {'title': f'{title}<br><i>All Portfolios<i>'},
-              ]))
-
-   # Create text and hovertext for the scatter plot
-    text = [f'<b>{name}</b>' for name in names]
     hovertext = [f'<b>{name}</b><br><i>Expected Return:</i> {ret:.1%}<br><i>Volatility:</i> {vol:.1%}<br><b><i>Sharpe Ratio:</i></b> <b>{sr:.2f}</b>'
-                for name, ret, vol, sr in zip(names, portfolio_returns, portfolio_volatilities, sharpe_ratios)]
-    
-    colorscale = 'Portland'  # Specify the desired colorscale
-    colors = sample_colorscale(colorscale, minmax_scale(sharpe_ratios, (0,1))) # type: ignore
-    
-    min_sharpe = min(sharpe_ratios)
-    max_sharpe = max(sharpe_ratios)
-
-    for i, portfolio in enumerate(portfolios):
-        # Create a scatter plot
-        scatter = go.Scatter(x=[portfolio_returns[i]],
-                            y=[portfolio_volatilities[i]],
-                            mode='markers+text',
-                            text=[text[i]],
-                            hovertext=[hovertext[i]],
-                            hovertemplate='%{hovertext}<extra></extra>',
-                            textposition='bottom center',
-                            marker=dict(
-                                size=15,
-                                color=colors[i],
-                                colorscale=colorscale,
-                                cmin=min_sharpe,  # Minimum value for colorbar
-                                cmax=max_sharpe,  # Maximum value for colorbar
-                                colorbar=dict(
-                                    title='Sharpe Ratio',
-                                    titlefont=dict(size=14),
-                                    tickformat='.2f',
-                                ),
-                                showscale=True,
-                                line=dict(
-                                    color='DarkSlateGrey',
-                                    width=0.5
-                                ),
-                            ),
-                            name='Portfolios Performance')
-        fig.add_trace(scatter, row=1, col=1)
-        
+                 for name, ret, vol, sr in zip(names, portfolio_returns, portfolio_volatilities, sharpe_ratios)]
+
+    data = [{
+        'type': 'scatter',
+        'x': portfolio_returns,
+        'y': portfolio_volatilities,
+        'mode': 'markers+text',
+        'text': [f'<b>{name}</b>' for name in names],
+        'hovertext': hovertext,
+        'hovertemplate': '%{hovertext}<extra></extra>',
+        'textposition': 'bottom center',
+        'marker': {
+            'size': 15,
+            'color': sharpe_ratios,
+            'colorscale': colorscale,
+            'cmin': min_sharpe,
+            'cmax': max_sharpe,
+            'colorbar': {'title': {'text': 'Sharpe Ratio', 'font': {'size': 14}}, 'tickformat': '.2f'},
+            'showscale': True,
+            'line': {'color': 'DarkSlateGrey', 'width': 0.5},
+        },
+        'name': 'Portfolios Performance',
+        'xaxis': 'x',
+        'yaxis': 'y',
+    }]
+    for portfolio, color in zip(portfolios, colors):
+        data.append({
+            'type': 'bar',
+            'x': list(portfolio.tickers),
+            'y': np.asarray(portfolio.weights, dtype=np.float64).tolist(),
+            'marker': {'color': color},
+            'name': f'Asset Weights for {portfolio.name}',
+            'xaxis': 'x2',
+            'yaxis': 'y2',
+        })
+    if frontier is not None:
+        solved = frontier.solved
+        data.append({
+            'type': 'scatter',
+            'x': frontier.expected_returns[solved].tolist(),
+            'y': frontier.volatility[solved].tolist(),
+            'mode': 'lines',
+            'line': {'color': 'DarkSlateGrey', 'width': 1.5, 'dash': 'dot'},
+            'hovertemplate': '<i>Expected Return:</i> %{x:.1%}<br><i>Volatility:</i> %{y:.1%}<extra>Efficient Frontier</extra>',
+            'name': 'Efficient Frontier',
+            'xaxis': 'x',
+            'yaxis': 'y',
+        })
+
+    subplot_titles = [
+        {'text': '<b>Portfolio Performance</b>', 'x': 0.5, 'y': 1, 'xref': 'paper', 'yref': 'paper',
+         'xanchor': 'center', 'yanchor': 'bottom', 'showarrow': False, 'font': {'size': 16}},
+        {'text': '<b>Asset Weights</b>', 'x': 0.5, 'y': 0.425, 'xref': 'paper', 'yref': 'paper',
+         'xanchor': 'center', 'yanchor': 'bottom', 'showarrow': False, 'font': {'size': 16}},
+    ]
+
+    if not portfolios:
+        subplot_titles = subplot_titles + [{'text': '<b>No portfolio could be optimized</b>', 'showarrow': False,
+                                            'x': 0.5, 'y': 0.2, 'xref': 'paper', 'yref': 'paper', 'font': {'size': 16}}]
+
+    # The scatter and the efficient frontier stay visible, the dropdown picks the bar traces
+    n_portfolios = len(portfolios)
+    n_frontier_traces = 1 if frontier is not None else 0
+    n_traces = 1 + n_portfolios + n_frontier_traces
+    # Restyle cycles an array value over the traces, so selectedpoints gets one entry per trace
+    dropdown_menu = [{
+        'label': 'All Portfolios',
+        'method': 'update',
+        'args': [{'visible': [True] * n_traces, 'selectedpoints': [None] * n_traces},
+                 {'title.text': f'{title}<br><i>All Portfolios<i>', 'annotations': subplot_titles}],
+    }]
     for i, portfolio in enumerate(portfolios):
-        # Create a dropdown menu for each portfolio
-        visible = [False] * len(portfolios)  # Initially, set all traces to invisible
-        visible[i] = True  # Set the selected portfolio trace to visible
-
-        dropdown_menu.append(dict(
-            label=portfolio.name, 
-            method='update', 
-            args=[
-                {'visible': visible},
-                {'title': f'{title}<br><i>{portfolio.name}<i>',
-                 # TODO: Dynamic annotations or Subplot titles?
-                 'annotations': [go.layout.Annotation(
-                                    text=hovertext[i],
-                                    showarrow=False,
-                                    x=1,  # X-coordinate of the annotation
-                                    y=0.50,  # Y-coordinate of the annotation
-                                    xref='paper',  # Reference the x-coordinate to the paper (layout) coordinates
-                                    yref='paper',  # Reference the y-coordinate to the paper (layout) coordinates
-                                    font=dict(color=colors[i])  # Customize the font color of the annotation
-                                )]
-                }
-            ]))
-
-        # Create a bar chart
-        asset_weights = portfolio.clean_weights
-        asset_names = list(asset_weights.keys())
-        asset_values = list(asset_weights.values())
-
-        bar_chart = go.Bar(x=asset_names, y=asset_values, 
-                           marker_color=colors[i],
-                           name=f'Asset Weights for {portfolio.name}')
-        fig.add_trace(bar_chart, row=2, col=1)
-
-    fig.update_layout(
-        coloraxis=dict(colorscale=colorscale),
-        title=f'{title}<br><i>All Portfolios<i>',
-        autosize=True,
-        plot_bgcolor='rgb(243, 243, 243)',
-        paper_bgcolor='rgb(243, 243, 243)',
-        font=dict(
-            family='Arial',
-            size=12,
-            color='black'
-        ),
-        showlegend=False,
-        updatemenus=[dict(
-            buttons=dropdown_menu,
-            direction="down",
-            pad={"r": 0, "t": 0},
-            showactive=True,
-            x=0.13,
-            y=0.50,
-        )]
-    )
-
-    x_range, y_range = zoom(portfolio_returns, portfolio_volatilities, 50)
-
-    # Update the layout with the new zoomed ranges
-    fig.update_layout(
-        xaxis=dict(range=x_range),
-        yaxis=dict(range=y_range)
-    )
-
-    # Add a grid and axis line customization for the first subplot
-    fig.update_xaxes(showgrid=True, gridwidth=0.5, gridcolor='lightgray', zeroline=False, title_text='<b>Expected Returns</b>', tickformat='.1%', tickfont=dict(size=10), row=1, col=1)
-    fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='lightgray', zeroline=False, title_text='<b>Volatility (Standard Deviation)</b>', tickformat='.1%', tickfont=dict(size=10), row=1, col=1)
-    
-    # Add a grid and axis line customization for the second subplot
-    fig.update_xaxes(showgrid=True, gridwidth=0.5, gridcolor='lightgray', zeroline=False, title_text='<b>Asset Names</b>', row=2, col=1)
-    fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='lightgray', zeroline=False, title_text='<b>Asset Weights</b>', tickformat='.1%', row=2, col=1)
-
-    # Move the title to the right
-    fig.update_layout(title_x=0.475, title_y=0.95)
-
-    # fig.show()
-
-    graph_data = fig.to_html(full_html=False)
-
-    return graph_data
+        visible = [True] + [j == i for j in range(n_portfolios)] + [True] * n_frontier_traces
+        dropdown_menu.append({
+            'label': portfolio.name,
+            'method': 'update',
+            'args': [
+                {'visible': visible, 'selectedpoints': [[i]] + [None] * (n_traces - 1)},
+                {'title.text': f'{title}<br><i>{portfolio.name}<i>',
+                 'annotations': subplot_titles + [{'text': hovertext[i], 'showarrow': False, 'x': 1, 'y': 0.50,
+                                  'xref': 'paper', 'yref': 'paper', 'font': {'color': colors[i]}}]},
+            ]})
+
+    # Keep the frontier in view along with the portfolios
+    zoom_returns, zoom_volatilities = list(portfolio_returns), list(portfolio_volatilities)
+    if frontier is not None:
+        zoom_returns += frontier.expected_returns[frontier.solved].tolist()
+        zoom_volatilities += frontier.volatility[frontier.solved].tolist()
+    x_range, y_range = zoom(zoom_returns, zoom_volatilities, 50) if zoom_returns else (None, None)
+    grid = {'showgrid': True, 'gridwidth': 0.5, 'gridcolor': 'lightgray', 'zeroline': False}
+    layout = {
+        'title': {'text': f'{title}<br><i>All Portfolios<i>', 'x': 0.475, 'y': 0.95},
+        'autosize': True,
+        'plot_bgcolor': 'rgb(243, 243, 243)',
+        'paper_bgcolor': 'rgb(243, 243, 243)',
+        'font': {'family': 'Arial', 'size': 12, 'color': 'black'},
+        'showlegend': False,
+        'updatemenus': [{'buttons': dropdown_menu, 'direction': 'down', 'pad': {'r': 0, 't': 0},
+                         'showactive': True, 'x': 0.13, 'y': 0.50}],
+        # Two stacked subplots: performance on top, asset weights below
+        'xaxis': dict(grid, anchor='y', domain=[0, 1], range=x_range, title={'text': '<b>Expected Returns</b>'},
+                      tickformat='.1%', tickfont={'size': 10}),
+        'yaxis': dict(grid, anchor='x', domain=[0.575, 1], range=y_range,
+                      title={'text': '<b>Volatility (Standard Deviation)</b>'}, tickformat='.1%', tickfont={'size': 10}),
+        'xaxis2': dict(grid, anchor='y2', domain=[0, 1], title={'text': '<b>Asset Names</b>'}),
+        'yaxis2': dict(grid, anchor='x2', domain=[0, 0.425], title={'text': '<b>Asset Weights</b>'}, tickformat='.1%'),
+        'annotations': subplot_titles,
+    }
+    return {'data': data, 'layout': layout}
 
 def zoom(portfolio_returns, portfolio_volatilities, zoom_percent):
     x_max = max(portfolio_returns)